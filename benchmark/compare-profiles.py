@@ -0,0 +1,92 @@
+import argparse
+import io
+import json
+import math
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from PIL import Image, ImageChops, ImageStat
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # The repository root, for load_script
+from load_script import process_photos
+
+# Function to compute the PSNR of an encoded image against the image it was encoded from
+def psnr(original, encoded_bytes):
+    with Image.open(io.BytesIO(encoded_bytes)) as decoded:
+        difference = ImageChops.difference(original.convert('RGB'), decoded.convert('RGB'))
+    mse = sum(value ** 2 for value in ImageStat.Stat(difference).rms) / 3
+    return 10 * math.log10(255 ** 2 / mse) if mse else float('inf')
+
+# Function to pick `sample` posts spread evenly over the export and decode their images once
+def load_sample(source, sample):
+    with source.open_posts() as f:
+        entries = list(process_photos.iter_posts(f))
+    step = max(1, len(entries) // sample)
+    images = []
+    for entry in entries[::step][:sample]:
+        primary = source.find(Path(entry['primary']['path']).name)
+        secondary = source.find(Path(entry['secondary']['path']).name)
+        if primary is None or secondary is None:
+            continue
+        taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
+        metadata = process_photos.build_metadata(taken_at, entry.get('location'), entry.get('caption'))
+        primary_image = process_photos.decode_image(source, primary)
+        secondary_image = process_photos.decode_image(source, secondary)
+        combined_image = process_photos.combine_images_with_resizing(primary_image, secondary_image)
+        images += [(primary_image, metadata), (secondary_image, metadata), (combined_image, metadata)]
+    return images
+
+# Function to encode every sample image with every profile and measure encode time, output size and PSNR
+def compare_profiles(images, profiles):
+    report = {}
+    for name in profiles:
+        profile = process_photos.ENCODER_PROFILES[name]
+        encode_time = 0.0
+        output_bytes = 0
+        psnr_values = []
+        for img, metadata in images:
+            encoded = io.BytesIO()
+            start = time.perf_counter()
+            process_photos.save_image(img, encoded, metadata, profile)
+            encode_time += time.perf_counter() - start
+            output_bytes += encoded.tell()
+            psnr_values.append(psnr(img, encoded.getvalue()))
+        report[name] = {
+            'format': profile['format'],
+            'options': profile['options'],
+            'images': len(images),
+            'encode_ms_per_image': encode_time / len(images) * 1000,
+            'kb_per_image': output_bytes / len(images) / 1000,
+            'mean_psnr_db': sum(psnr_values) / len(psnr_values),
+        }
+    return report
+
+def print_report(report):
+    baseline = report.get(process_photos.default_profile)
+    print(f"{'profile':<18}{'format':<8}{'encode ms':>11}{'KB/image':>10}{'size':>8}{'PSNR dB':>9}")
+    for name, result in report.items():
+        relative_size = f"{result['kb_per_image'] / baseline['kb_per_image']:.0%}" if baseline else ''
+        print(f"{name:<18}{result['format']:<8}{result['encode_ms_per_image']:>11.1f}{result['kb_per_image']:>10.1f}"
+              f"{relative_size:>8}{result['mean_psnr_db']:>9.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the encoder profiles of process-photos.py on a sample of an export.")
+    parser.add_argument('--input', default='.', help="unzipped export folder or the BeReal GDPR ZIP file (default: current folder)")
+    parser.add_argument('--sample', type=int, default=10, help="number of posts to encode (default: 10)")
+    parser.add_argument('--profiles', nargs='+', default=None, choices=list(process_photos.ENCODER_PROFILES),
+                        help="profiles to compare (default: all that this Pillow installation supports)")
+    parser.add_argument('--json', default=None, help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    Image.init()
+    profiles = args.profiles or [name for name, profile in process_photos.ENCODER_PROFILES.items() if profile['format'] in Image.SAVE]
+    images = load_sample(process_photos.open_source(args.input), args.sample)
+    if not images:
+        raise SystemExit("No posts with both images found in the export.")
+    print(f"Encoding {len(images)} images ({len(images) // 3} posts: primary, secondary and combined) with {len(profiles)} profiles...\n")
+    report = compare_profiles(images, profiles)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from PIL import Image, ImageDraw
+
+# BeReal images are 1500x2000 pixels, for the primary and the secondary camera
+BEREAL_SIZE = (1500, 2000)
+
+# Textures shared by all images generated in one process; each image is a different crop of them
+_textures = None
+
+def _get_textures(size):
+    global _textures
+    if _textures is None or _textures[0].size != (size[0] + 200, size[1] + 200):
+        texture_size = (size[0] + 200, size[1] + 200)
+        # Low-frequency noise for "scenery", a gradient for "sky" and fine noise for sensor grain
+        blobs = Image.effect_noise((texture_size[0] // 10, texture_size[1] // 10), 60).resize(texture_size, Image.Resampling.BICUBIC)
+        gradient = Image.linear_gradient('L').resize(texture_size)
+        grain = Image.effect_noise(texture_size, 20)
+        _textures = (blobs, gradient, Image.blend(blobs, grain, 0.3))
+    return _textures
+
+# Function to render one unique, photo-like WebP image
+def generate_image(path, index, size, seed):
+    rng = random.Random(seed * 1_000_003 + index)
+    blobs, gradient, grain = _get_textures(size)
+    x, y = rng.randrange(200), rng.randrange(200)
+    bands = [texture.crop((x, y, x + size[0], y + size[1])) for texture in (blobs, gradient, grain)]
+    rng.shuffle(bands)
+    img = Image.merge('RGB', bands)
+
+    # Stamp a few shapes so every file has different content (and a different hash)
+    draw = ImageDraw.Draw(img)
+    for _ in range(3):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x0, y0, x0 + rng.randrange(50, 400), y0 + rng.randrange(50, 400)), fill=tuple(rng.randrange(256) for _ in range(3)))
+    draw.text((40, 40), f"#{index}", fill=(255, 255, 255))
+
+    img.save(path, 'WEBP', quality=80, method=0)
+    return path
+
+def _generate_image_job(job):
+    return generate_image(*job)
+
+# Function to generate a fake BeReal export with posts.json, Photos/post and the legacy Photos/bereal folder
+def generate_export(root, posts, size=BEREAL_SIZE, legacy_fraction=0.1, location_fraction=0.5, caption_fraction=0.3,
+                    collision_fraction=0.01, unique_images=None, workers=None, seed=1):
+    root = Path(root)
+    rng = random.Random(seed)
+    post_folder = root / 'Photos' / 'post'
+    bereal_folder = root / 'Photos' / 'bereal'
+    post_folder.mkdir(parents=True, exist_ok=True)
+    bereal_folder.mkdir(parents=True, exist_ok=True)
+
+    entries = []
+    image_jobs = []
+    taken_at = datetime(2022, 1, 1, 12, 0, 0)
+    for index in range(posts):
+        # Mostly one post a day, sometimes two in the same second (which causes filename collisions)
+        if index == 0 or rng.random() >= collision_fraction:
+            taken_at += timedelta(days=1, seconds=rng.randrange(-7200, 7200))
+        folder = bereal_folder if rng.random() < legacy_fraction else post_folder
+
+        entry = {}
+        for role in ['primary', 'secondary']:
+            filename = f"{rng.getrandbits(64):016x}.webp"
+            image_number = len(image_jobs)
+            if unique_images and image_number >= unique_images:
+                # Reuse an already generated image to keep generation fast for large exports
+                source = image_jobs[image_number % unique_images][0]
+                image_jobs.append((folder / filename, source))
+            else:
+                image_jobs.append((folder / filename, None))
+            entry[role] = {'path': f"/Photos/{folder.name}/{filename}", 'width': size[0], 'height': size[1]}
+
+        entry['takenAt'] = taken_at.strftime("%Y-%m-%dT%H:%M:%S.") + f"{rng.randrange(1000):03d}Z"
+        if rng.random() < location_fraction:
+            entry['location'] = {'latitude': round(rng.uniform(-60, 70), 6), 'longitude': round(rng.uniform(-180, 180), 6)}
+        if rng.random() < caption_fraction:
+            entry['caption'] = rng.choice(["Sunday vibes", "Café ☕", "Back at work", "Concert 🎶", "Snow day"])
+        entries.append(entry)
+
+    # Render the unique images in parallel, then copy the reused ones
+    render_jobs = [(path, index, size, seed) for index, (path, source) in enumerate(image_jobs) if source is None]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for _ in executor.map(_generate_image_job, render_jobs, chunksize=8):
+            pass
+    for path, source in image_jobs:
+        if source is not None:
+            path.write_bytes(source.read_bytes())
+
+    with open(root / 'posts.json', 'w', encoding='utf8') as f:
+        json.dump(entries, f, ensure_ascii=False, indent=2)
+    return entries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic BeReal GDPR export for benchmarking.")
+    parser.add_argument('output', help="folder to create the export in")
+    parser.add_argument('--posts', type=int, default=100, help="number of posts in posts.json (default: 100)")
+    parser.add_argument('--width', type=int, default=BEREAL_SIZE[0])
+    parser.add_argument('--height', type=int, default=BEREAL_SIZE[1])
+    parser.add_argument('--legacy-fraction', type=float, default=0.1, help="share of posts stored in Photos/bereal")
+    parser.add_argument('--unique-images', type=int, default=None,
+                        help="render only this many distinct images and reuse them (faster for large exports)")
+    parser.add_argument('--workers', type=int, default=None, help="processes used to render images")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    generate_export(args.output, args.posts, size=(args.width, args.height), legacy_fraction=args.legacy_fraction,
+                    unique_images=args.unique_images, workers=args.workers, seed=args.seed)
+    print(f"Generated {args.posts} posts in {args.output}")
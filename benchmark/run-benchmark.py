@@ -0,0 +1,150 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+benchmark_folder = Path(__file__).resolve().parent
+sys.path.insert(0, str(benchmark_folder.parent)) # The repository root, for load_script
+from load_script import process_photos, script_path
+
+# Function to time a callable once and add the duration to the stage's samples
+def timed(samples, stage, function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    samples.setdefault(stage, []).append(time.perf_counter() - start)
+    return value
+
+def summarize(samples):
+    summary = {}
+    for stage, durations in samples.items():
+        durations = sorted(durations)
+        summary[stage] = {
+            'count': len(durations),
+            'total_s': sum(durations),
+            'mean_ms': statistics.mean(durations) * 1000,
+            'p50_ms': durations[len(durations) // 2] * 1000,
+            'p95_ms': durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000,
+        }
+    return summary
+
+# Function to time each stage of processing separately, on the first `sample` posts of an export
+def benchmark_stages(export_root, sample):
+    source = process_photos.DirectorySource(export_root)
+    samples = {}
+    with source.open_posts() as f:
+        entries = list(process_photos.iter_posts(f))
+
+    # Lookup is cheap, so it is timed for the whole export
+    refs = []
+    for entry in entries:
+        primary = timed(samples, 'lookup', source.find, Path(entry['primary']['path']).name)
+        secondary = timed(samples, 'lookup', source.find, Path(entry['secondary']['path']).name)
+        refs.append((entry, primary, secondary))
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        for index, (entry, primary, secondary) in enumerate(refs[:sample]):
+            if primary is None or secondary is None:
+                continue
+            taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
+            exif = timed(samples, 'exif', process_photos.build_exif, taken_at, entry.get('location'), entry.get('caption'))
+            iptc = timed(samples, 'iptc', process_photos.build_iptc, entry.get('caption'))
+            metadata = {'exif': exif, 'iptc': iptc}
+
+            images = {}
+            for role, ref in [('primary', primary), ('secondary', secondary)]:
+                images[role] = timed(samples, 'decode', process_photos.decode_image, source, ref)
+                encoded = io.BytesIO()
+                timed(samples, 'encode', process_photos.save_image, images[role], encoded, metadata)
+                timed(samples, 'write', Path(output_folder, f"{index}_{role}.jpg").write_bytes, encoded.getvalue())
+
+            combined = timed(samples, 'combine', process_photos.combine_images_with_resizing, images['primary'], images['secondary'])
+            encoded = io.BytesIO()
+            timed(samples, 'encode', process_photos.save_image, combined, encoded, metadata)
+            timed(samples, 'write', Path(output_folder, f"{index}_combined.jpg").write_bytes, encoded.getvalue())
+            combined.close()
+            for img in images.values():
+                img.close()
+
+    return summarize(samples)
+
+# Function to run process-photos.py end to end on an export and measure wall time, peak RSS and output size
+def benchmark_run(export_root, workers, extra_args=()):
+    # Start from a clean output folder so every run does the full work
+    for folder in ['Photos/post/__processed', 'Photos/post/__combined']:
+        shutil.rmtree(Path(export_root, folder), ignore_errors=True)
+
+    input_bytes = sum(path.stat().st_size for path in Path(export_root, 'Photos').rglob('*.webp'))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, str(script_path), '--workers', str(workers), *extra_args],
+                               cwd=export_root, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    process.stdin.write(b"\n") # Accept the default settings
+    process.stdin.close()
+    # wait4 reports the peak RSS of the script and the worker processes it waited for
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+
+    output_files = [path for folder in ['Photos/post/__processed', 'Photos/post/__combined']
+                    for path in Path(export_root, folder).glob('*.jpg')]
+    output_bytes = sum(path.stat().st_size for path in output_files)
+    peak_rss_mb = rusage.ru_maxrss / 1024 if sys.platform != 'darwin' else rusage.ru_maxrss / 1024 / 1024
+    return {
+        'exit_status': os.waitstatus_to_exitcode(status),
+        'workers': workers,
+        'wall_time_s': wall_time,
+        'input_mb': input_bytes / 1e6,
+        'output_files': len(output_files),
+        'output_mb': output_bytes / 1e6,
+        'peak_rss_mb': peak_rss_mb,
+        'throughput_files_per_s': len(output_files) / wall_time,
+        'throughput_input_mb_per_s': input_bytes / 1e6 / wall_time,
+    }
+
+def print_report(report):
+    for size, result in report.items():
+        print(f"\n=== {size} posts ===")
+        print(f"{'stage':<10}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}")
+        for stage, stats in result['stages'].items():
+            print(f"{stage:<10}{stats['count']:>8}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['total_s']:>10.2f}")
+        run = result['run']
+        print(f"End to end with {run['workers']} worker(s): {run['wall_time_s']:.1f} s, "
+              f"{run['throughput_files_per_s']:.1f} files/s, {run['throughput_input_mb_per_s']:.1f} MB/s read, "
+              f"peak RSS {run['peak_rss_mb']:.0f} MB, {run['output_files']} files / {run['output_mb']:.1f} MB written")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark process-photos.py on synthetic BeReal exports.")
+    parser.add_argument('--posts', type=int, nargs='+', default=[100, 1000, 10000], help="export sizes to benchmark")
+    parser.add_argument('--workdir', default=None, help="folder for the generated exports (kept between runs)")
+    parser.add_argument('--sample', type=int, default=50, help="posts used for the per-stage timings")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="workers for the end-to-end run")
+    parser.add_argument('--unique-images', type=int, default=None, help="passed on to the export generator")
+    parser.add_argument('--json', default=None, help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='bereal-benchmark-'))
+    report = {}
+    for posts in args.posts:
+        export_root = workdir / f"export-{posts}"
+        if not (export_root / 'posts.json').exists():
+            print(f"Generating export with {posts} posts in {export_root}...")
+            # Run the generator as its own script, so its worker processes can import it
+            generate_command = [sys.executable, str(benchmark_folder / 'generate-export.py'), str(export_root), '--posts', str(posts)]
+            if args.unique_images:
+                generate_command += ['--unique-images', str(args.unique_images)]
+            subprocess.run(generate_command, check=True)
+        report[posts] = {
+            'stages': benchmark_stages(export_root, args.sample),
+            'run': benchmark_run(export_root, args.workers),
+        }
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
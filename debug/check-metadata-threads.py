@@ -0,0 +1,32 @@
+import sys
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # The repository root, for load_script
+from load_script import process_photos
+
+# The decode threads of --pipeline build the metadata of different posts at the same time.
+# Build metadata for many posts on several threads and check that every IPTC block has the caption of its own post.
+threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+posts_per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+sys.setswitchinterval(1e-6) # Switch threads as often as possible, to make a race likely to show
+mismatches = []
+
+def build(thread_index):
+    for index in range(posts_per_thread):
+        caption = f"post {thread_index}-{index}" if index % 3 else None
+        metadata = process_photos.build_metadata(datetime(2023, 1, 1) + timedelta(minutes=index), None, caption)
+        found = process_photos._iptc_caption(metadata['iptc'][4:]) # Skip the APP13 marker and length
+        if found != caption:
+            mismatches.append((caption, found))
+
+workers = [threading.Thread(target=build, args=(thread_index,)) for thread_index in range(threads)]
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+
+print(f"{threads * posts_per_thread} IPTC blocks built on {threads} threads, {len(mismatches)} with the caption of another post")
+for caption, found in mismatches[:10]:
+    print(f"expected {caption!r}, found {found!r}")
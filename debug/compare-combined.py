@@ -0,0 +1,41 @@
+import sys
+import time
+from pathlib import Path
+from PIL import Image, ImageChops, ImageStat
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent)) # The repository root, for load_script
+from load_script import process_photos
+
+# Specify the primary and secondary image of one post (or pass them as arguments)
+primary_path = Path(sys.argv[1] if len(sys.argv) > 1 else 'path-to-primary.webp')
+secondary_path = Path(sys.argv[2] if len(sys.argv) > 2 else 'path-to-secondary.webp')
+source = process_photos.DirectorySource('.')
+
+primary_image = process_photos.decode_image(source, primary_path)
+
+# Combined image as before: full-resolution decode of the secondary image, then LANCZOS
+start = time.perf_counter()
+secondary_image = process_photos.decode_image(source, secondary_path)
+full_decode = process_photos.combine_images_with_resizing(primary_image, secondary_image)
+full_decode_time = time.perf_counter() - start
+
+# Combined image with the reduced-size decode of the secondary image
+start = time.perf_counter()
+overlay = process_photos.decode_secondary_overlay(source, secondary_path)
+reduced_decode = process_photos.combine_images(primary_image, overlay)
+reduced_decode_time = time.perf_counter() - start
+
+# Compare both renderings
+difference = ImageChops.difference(full_decode, reduced_decode)
+print(f"Full decode: {full_decode_time * 1000:.1f} ms, reduced decode: {reduced_decode_time * 1000:.1f} ms")
+print(f"Max difference per band: {[band[1] for band in difference.getextrema()]}")
+print(f"Mean difference per band: {[round(mean, 3) for mean in ImageStat.Stat(difference).mean]}")
+
+# Save full decode | reduced decode | amplified difference side by side for visual inspection
+width, height = full_decode.size
+side_by_side = Image.new('RGB', (width * 3, height))
+side_by_side.paste(full_decode, (0, 0))
+side_by_side.paste(reduced_decode, (width, 0))
+side_by_side.paste(difference.point(lambda value: min(255, value * 10)), (width * 2, 0))
+side_by_side.save('compare-combined.png')
+print("Saved side-by-side comparison to compare-combined.png")
@@ -0,0 +1,8 @@
+import importlib.util
+from pathlib import Path
+
+# Load process-photos.py as a module (its name is not importable), for the scripts in debug/ and benchmark/
+script_path = Path(__file__).resolve().parent / 'process-photos.py'
+spec = importlib.util.spec_from_file_location('process_photos', script_path)
+process_photos = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(process_photos)
@@ -1,13 +1,51 @@
+import argparse
+import bisect
+import calendar
+import codecs
+import contextlib
+import functools
+import hashlib
+import importlib
+import io
 import json
+import math
+import queue
+import threading
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageOps, ExifTags
 import logging
-from pathlib import Path
-import piexif
+from pathlib import Path, PurePosixPath
 import os
 import time
 import shutil
-from iptcinfo3 import IPTCInfo
+import struct
+import sys
+import tarfile
+try:
+    import fcntl # Used for reflinks; not available on Windows
+except ImportError:
+    fcntl = None
+
+# Module that is only imported when one of its attributes is first used
+# Pillow and piexif take longer to import than a plan takes to make, so they are loaded
+# when real processing starts (in worker processes too) rather than at startup
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+Image = LazyModule('PIL.Image')
+ImageChops = LazyModule('PIL.ImageChops')
+ImageDraw = LazyModule('PIL.ImageDraw')
+piexif = LazyModule('piexif')
 
 # ANSI escape codes for text styling
 STYLING = {
@@ -19,15 +57,16 @@ STYLING = {
 }
 
 #Setup log styling
+# Summary messages are logged with extra={'summary': True}, so records are styled without searching their text
 class ColorFormatter(logging.Formatter):
     def format(self, record):
         message = super().format(record)
-        if record.levelno == logging.INFO and "Finished processing" not in record.msg and "Re-saved" not in record.msg:
+        if getattr(record, 'summary', False):  # Identify the summary message
+            message = STYLING["BLUE"] + STYLING["BOLD"] + message + STYLING["RESET"]
+        elif record.levelno == logging.INFO:
             message = STYLING["GREEN"] + message + STYLING["RESET"]
         elif record.levelno == logging.ERROR:
             message = STYLING["RED"] + message + STYLING["RESET"]
-        elif "Finished processing" in record.msg or "Re-saved" in record.msg:  # Identify the summary message
-            message = STYLING["BLUE"] + STYLING["BOLD"] + message + STYLING["RESET"]
         return message
 
 # Setup basic logging
@@ -38,120 +77,514 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 handler = logger.handlers[0]  # Get the default handler installed by basicConfig
 handler.setFormatter(ColorFormatter('%(asctime)s - %(levelname)s - %(message)s'))
-
-# Initialize counters
-processed_files_count = 0
-converted_files_count = 0
-combined_files_count = 0
-skipped_files_count = 0
+# Keep the debug messages of Pillow out of --verbose output
+logging.getLogger('PIL').setLevel(logging.INFO)
+
+# Per-stage timing, byte and error counters for a run
+# Every worker collects its own Telemetry for a job and returns it as a dict; the main process merges them.
+class Telemetry:
+    # Upper bounds of the latency histogram buckets in milliseconds (the last bucket is open-ended)
+    BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self, trace=False):
+        self.stages = {}
+        self.bytes = {'read': 0, 'written': 0}
+        self.trace_events = [] if trace else None
+        self.pipeline = {} # Throughput of the pipeline stages, when the pipeline is used
+
+    def _stage_stats(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'count': 0, 'errors': 0, 'total_ms': 0.0, 'min_ms': None, 'max_ms': 0.0,
+                                 'histogram': [0] * (len(self.BUCKETS_MS) + 1)}
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._stage_stats(name)['errors'] += 1
+            raise
+        finally:
+            end = time.perf_counter()
+            duration_ms = (end - start) * 1000
+            stats = self._stage_stats(name)
+            stats['count'] += 1
+            stats['total_ms'] += duration_ms
+            stats['min_ms'] = duration_ms if stats['min_ms'] is None else min(stats['min_ms'], duration_ms)
+            stats['max_ms'] = max(stats['max_ms'], duration_ms)
+            stats['histogram'][bisect.bisect_left(self.BUCKETS_MS, duration_ms)] += 1
+            if self.trace_events is not None:
+                # Chrome trace "complete" event; timestamps in microseconds
+                self.trace_events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                                          'pid': os.getpid(), 'tid': threading.get_ident()})
+
+    def add_bytes(self, kind, count):
+        self.bytes[kind] += count
+
+    def to_dict(self):
+        return {'stages': self.stages, 'bytes': self.bytes, 'trace_events': self.trace_events}
+
+    def merge(self, other):
+        for name, other_stats in other['stages'].items():
+            stats = self._stage_stats(name)
+            for key in ['count', 'errors', 'total_ms']:
+                stats[key] += other_stats[key]
+            if other_stats['min_ms'] is not None:
+                stats['min_ms'] = other_stats['min_ms'] if stats['min_ms'] is None else min(stats['min_ms'], other_stats['min_ms'])
+            stats['max_ms'] = max(stats['max_ms'], other_stats['max_ms'])
+            stats['histogram'] = [a + b for a, b in zip(stats['histogram'], other_stats['histogram'])]
+        for kind, count in other['bytes'].items():
+            self.bytes[kind] += count
+        if self.trace_events is not None and other['trace_events']:
+            self.trace_events.extend(other['trace_events'])
+
+    # Function to write the run report, and optionally a trace that chrome://tracing or Perfetto can open
+    def write_report(self, report_path, counters, wall_time, trace_path=None):
+        stages = {}
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats, mean_ms=stats['total_ms'] / stats['count'] if stats['count'] else 0.0)
+        report = {
+            'wall_time_s': wall_time,
+            'counters': counters,
+            'bytes': self.bytes,
+            'histogram_buckets_ms': self.BUCKETS_MS,
+            'stages': stages,
+        }
+        if self.pipeline:
+            report['pipeline'] = self.pipeline
+        with open(report_path, 'w', encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+        if trace_path and self.trace_events is not None:
+            with open(trace_path, 'w', encoding="utf8") as f:
+                json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
 
 # Static IPTC tags
 source_app = "BeReal app"
 processing_tool = "github/bereal-gdpr-photo-toolkit"
 #keywords = ["BeReal"]
 
-# Define lists to hold the paths of images to be combined
-primary_images = []
-secondary_images = []
+# Size of the secondary image in combined images, relative to its original size
+secondary_scaling_factor = 1/3.33333333
+
+# Look of the combined images: the scale of the secondary image, the radius of its rounded corners,
+# the thickness of the black outline and the margin to the borders
+default_combined_style = {'scale': secondary_scaling_factor, 'corner_radius': 60, 'outline_size': 7, 'position': (55, 55)}
 
 # Define paths using pathlib
 photo_folder = Path('Photos/post/')
 bereal_folder = Path('Photos/bereal')
 output_folder = Path('Photos/post/__processed')
 output_folder_combined = Path('Photos/post/__combined')
-output_folder.mkdir(parents=True, exist_ok=True)  # Create the output folder if it doesn't exist
-
-# Print the paths
-print(STYLING["BOLD"] + "\nThe following paths are set for the input and output files:" + STYLING["RESET"])
-print(f"Photo folder: {photo_folder}")
-if os.path.exists(bereal_folder):
-    print(f"Older photo folder: {bereal_folder}")
-print(f"Output folder for singular images: {output_folder}")
-print(f"Output folder for combined images: {output_folder_combined}")
-#print("\nDeduplication is active. No files will be overwritten or deleted.")
-print("")
-
-# Function to count number of input files
-def count_files_in_folder(folder_path):
-    folder = Path(folder_path)
-    file_count = len(list(folder.glob('*.webp')))
-    return file_count
-
-number_of_files = count_files_in_folder(photo_folder)
-print(f"Number of WebP-files in {photo_folder}: {number_of_files}")
-
-if os.path.exists(bereal_folder):
-    number_of_files_bereal = count_files_in_folder(bereal_folder) # Use a different variable name
-    print(f"Number of (older) WebP-files in {bereal_folder}: {number_of_files_bereal}")
-
-# Settings
-## Initial choice for accessing advanced settings
-print(STYLING["BOLD"] + "\nDo you want to access advanced settings or run with default settings?" + STYLING["RESET"])
-print("Default settings are:\n"
-"1. Copied images are converted from WebP to JPEG\n"
-"2. Converted images' filenames do not contain the original filename\n"
-"3. Combined images are created on top of converted, singular images")
-advanced_settings = input("\nEnter " + STYLING["BOLD"] + "'yes'" + STYLING["RESET"] + "for advanced settings or press any key to continue with default settings: ").strip().lower()
-
-if advanced_settings != 'yes':
-    print("Continuing with default settings.\n")
-
-## Default responses
-convert_to_jpeg = 'yes'
-keep_original_filename = 'no'
-create_combined_images = 'yes'
-
-## Proceed with advanced settings if chosen
-if advanced_settings == 'yes':
-    # User choice for converting to JPEG
-    convert_to_jpeg = None
-    while convert_to_jpeg not in ['yes', 'no']:
-        convert_to_jpeg = input(STYLING["BOLD"] + "\n1. Do you want to convert images from WebP to JPEG? (yes/no): " + STYLING["RESET"]).strip().lower()
-        if convert_to_jpeg == 'no':
-            print("Your images will not be converted. No additional metadata will be added.")
-        if convert_to_jpeg not in ['yes', 'no']:
-            logging.error("Invalid input. Please enter 'yes' or 'no'.")
-
-    # User choice for keeping original filename
-    print(STYLING["BOLD"] + "\n2. There are two options for how output files can be named" + STYLING["RESET"] + "\n"
-    "Option 1: YYYY-MM-DDTHH-MM-SS_primary/secondary_original-filename.jpeg\n"
-    "Option 2: YYYY-MM-DDTHH-MM-SS_primary/secondary.jpeg\n"
-    "This will only influence the naming scheme of singular images.")
-    keep_original_filename = None
-    while keep_original_filename not in ['yes', 'no']:
-        keep_original_filename = input(STYLING["BOLD"] + "Do you want to keep the original filename in the renamed file? (yes/no): " + STYLING["RESET"]).strip().lower()
-        if keep_original_filename not in ['yes', 'no']:
-            logging.error("Invalid input. Please enter 'yes' or 'no'.")
-
-    # User choice for creating combined images
-    create_combined_images = None
-    while create_combined_images not in ['yes', 'no']:
-        create_combined_images = input(STYLING["BOLD"] + "\n3. Do you want to create combined images like the original BeReal memories? (yes/no): " + STYLING["RESET"]).strip().lower()
-        if create_combined_images not in ['yes', 'no']:
-            logging.error("Invalid input. Please enter 'yes' or 'no'.")
-
-if convert_to_jpeg == 'no' and create_combined_images == 'no':
-    print("You chose not to convert images nor do you want to output combined images.\n"
-    "The script will therefore only copy images to a new folder and rename them according to your choice without adding metadata or creating new files.\n"
-    "Script will continue to run in 5 seconds.")
-    #time.sleep(5) # Corrected sleep duration from 10 to 5 as per message
-
-# Function to convert WEBP to JPEG
-def convert_webp_to_jpg(image_path):
-    if image_path.suffix.lower() == '.webp':
-        # Create a .jpg path in the same directory as the source .webp file
-        jpg_path = image_path.with_suffix('.jpg')
+thumbnails_folder = Path('Photos/post/__thumbnails')
+render_cache_folder = Path('Photos/post/__render-cache')
+mosaic_folder = Path('Photos/post/__mosaics')
+manifest_path = output_folder / '.manifest.jsonl'
+
+# Input backends
+# A source gives access to posts.json and the images of one export. Images are addressed by a
+# reference (a Path or a ZIP member name) that has the usual .name/.stem/.suffix attributes.
+
+# Input read from an unzipped export in a folder
+class DirectorySource:
+    def __init__(self, root='.'):
+        self.root = Path(root)
+        self._files = None
+
+    def __str__(self):
+        return str(self.root)
+
+    # The index is rebuilt where it is needed instead of being sent along with every job
+    def __getstate__(self):
+        return dict(self.__dict__, _files=None)
+
+    # List Photos/post and Photos/bereal once with os.scandir; lookups and counts are answered from memory
+    def _index(self):
+        if self._files is None:
+            self._files = {}
+            for folder in [photo_folder, bereal_folder]:
+                try:
+                    with os.scandir(self.root / folder) as entries:
+                        self._files[folder.as_posix()] = {entry.name for entry in entries if entry.is_file()}
+                except FileNotFoundError:
+                    pass
+        return self._files
+
+    def open_posts(self):
+        return open(self.root / 'posts.json', 'rb')
+
+    def has_folder(self, folder):
+        return folder.as_posix() in self._index()
+
+    # Function to count number of input files
+    def count_files_in_folder(self, folder):
+        return sum(1 for name in self._index().get(folder.as_posix(), ()) if name.lower().endswith('.webp'))
+
+    # Look up an image in Photos/post first and then in the older Photos/bereal folder
+    def find(self, filename):
+        files = self._index()
+        for folder in [photo_folder, bereal_folder]:
+            if filename in files.get(folder.as_posix(), ()):
+                return self.root / folder / filename
+        return None
+
+    def open(self, ref):
+        return open(ref, 'rb')
+
+    def copy(self, ref, output_path, link_mode='copy'):
+        return link_file(ref, output_path, link_mode)
+
+    def stat(self, ref):
+        stat = os.stat(ref)
+        return stat.st_size, stat.st_mtime_ns
+
+    # XMP sidecars are written next to the image, with the same base name (as Lightroom and digiKam expect)
+    def sidecar_path(self, ref):
+        return ref.with_suffix('.xmp')
+
+# ZIP archives opened by this process, shared by all ZipSource objects for the same file.
+# A forked worker must not share the parent's file offset, so archives are keyed by process id too.
+_open_archives = {}
+_open_archives_lock = threading.Lock()
+
+# Input read straight from the BeReal GDPR ZIP, without unpacking it first
+class ZipSource:
+    def __init__(self, zip_path):
+        self.zip_path = Path(zip_path)
+
+    def __str__(self):
+        return str(self.zip_path)
+
+    # Open the archive once per process and index its members by folder and filename
+    def _archive(self):
+        key = (os.getpid(), str(self.zip_path))
+        with _open_archives_lock:
+            if key not in _open_archives:
+                archive = zipfile.ZipFile(self.zip_path)
+                members = {}
+                posts_member = None
+                for info in archive.infolist():
+                    member = PurePosixPath(info.filename)
+                    if member.name == 'posts.json' and (posts_member is None or len(member.parts) < len(posts_member.parts)):
+                        posts_member = member
+                    for folder in [photo_folder, bereal_folder]:
+                        # Members may sit below a top-level folder named after the export
+                        if member.parent.as_posix().endswith(folder.as_posix()):
+                            members[(folder.as_posix(), member.name)] = info
+                _open_archives[key] = (archive, members, posts_member)
+            return _open_archives[key]
+
+    def open_posts(self):
+        archive, members, posts_member = self._archive()
+        if posts_member is None:
+            raise FileNotFoundError(f"posts.json not found in {self.zip_path}")
+        return archive.open(posts_member.as_posix())
+
+    def has_folder(self, folder):
+        archive, members, posts_member = self._archive()
+        return any(key[0] == folder.as_posix() for key in members)
+
+    def count_files_in_folder(self, folder):
+        archive, members, posts_member = self._archive()
+        return sum(1 for key in members if key[0] == folder.as_posix() and key[1].lower().endswith('.webp'))
+
+    def find(self, filename):
+        archive, members, posts_member = self._archive()
+        for folder in [photo_folder, bereal_folder]:
+            info = members.get((folder.as_posix(), filename))
+            if info is not None:
+                return PurePosixPath(info.filename)
+        return None
+
+    def open(self, ref):
+        archive, members, posts_member = self._archive()
+        return archive.open(ref.as_posix())
+
+    # Members of an archive cannot be linked, so they are always copied
+    def copy(self, ref, output_path, link_mode='copy'):
+        tmp_path = temp_path(output_path)
+        with self.open(ref) as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        # Keep the modification time stored in the archive, like copy2 does for files
+        mtime = self._mtime(ref)
+        os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, output_path)
+        return 'copy'
+
+    def _mtime(self, ref):
+        archive, members, posts_member = self._archive()
+        return datetime(*archive.getinfo(ref.as_posix()).date_time).timestamp()
+
+    def stat(self, ref):
+        archive, members, posts_member = self._archive()
+        return archive.getinfo(ref.as_posix()).file_size, int(self._mtime(ref) * 1e9)
+
+    # XMP sidecars go to Photos/post or Photos/bereal in the current folder, where the image ends up when the archive
+    # is unzipped there. Only the folder and the file name are taken from the member name, so a member named
+    # ../x/Photos/post/a.webp or /x/Photos/post/a.webp can not place a sidecar outside the current folder.
+    def sidecar_path(self, ref):
+        if ref.name in ('', '.', '..') or '\\' in ref.name or ':' in ref.name:
+            raise ValueError(f"Unsafe member name in {self.zip_path}: {ref}")
+        for folder in [photo_folder, bereal_folder]:
+            if ref.parent.as_posix().endswith(folder.as_posix()):
+                return folder / PurePosixPath(ref.name).with_suffix('.xmp').name
+        raise ValueError(f"{ref} is not in {photo_folder} or {bereal_folder}")
+
+# Function to pick the input backend for a folder or ZIP file
+def open_source(input_path):
+    if zipfile.is_zipfile(input_path):
+        return ZipSource(input_path)
+    return DirectorySource(input_path)
+
+# ioctl request that clones a file's extents on copy-on-write filesystems (Btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+# Function to create output_path as a hardlink, reflink or copy of an existing file
+# Falls back to a copy where the filesystem does not support the link mode; returns the mode actually used
+# The link or copy is made under a temporary name and renamed into place, like every other output
+def link_file(src, output_path, link_mode='copy'):
+    tmp_path = temp_path(output_path)
+    if link_mode == 'hardlink':
         try:
-            with Image.open(image_path) as img:
-                img.convert('RGB').save(jpg_path, "JPEG", quality=80)
-                logging.info(f"Converted {image_path} to {jpg_path}.")
-            return jpg_path, True
-        except Exception as e:
-            logging.error(f"Error converting {image_path} to JPEG: {e}")
-            return None, False
+            # A rerun finds the output already linked to the same file; there is nothing to do then
+            if os.path.exists(output_path) and os.path.samefile(src, output_path):
+                return 'hardlink'
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(src, tmp_path)
+            os.replace(tmp_path, output_path)
+            # Renaming a link onto another link of the same file does nothing, which would leave the temporary name behind
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            return 'hardlink'
+        except OSError as e:
+            logging.debug(f"Could not hardlink {src} to {output_path}, copying instead: {e}")
+    elif link_mode == 'reflink' and fcntl is not None:
+        try:
+            with open(src, 'rb') as src_file, open(tmp_path, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, tmp_path)
+            os.replace(tmp_path, output_path)
+            return 'reflink'
+        except OSError as e:
+            logging.debug(f"Could not reflink {src} to {output_path}, copying instead: {e}")
+    shutil.copy2(str(src), tmp_path)
+    os.replace(tmp_path, output_path)
+    return 'copy'
+
+# Output sinks
+# A sink stores the outputs of a run, addressed by their planned paths. Every output is written exactly once,
+# complete, and never rewritten in place: into the output folders (DirectorySink) or into an archive (TarSink, ZipSink).
+
+# Function to get the temporary name an output is written to before it is renamed into place
+def temp_path(path):
+    path = Path(path)
+    return path.with_name(f".{path.name}.tmp")
+
+# Outputs written to the output folders. Each file is written under a temporary name and renamed into place,
+# so an interrupted run never leaves a half-written image under its final name. The files are flushed to disk
+# with one sync per batch of posts, before the manifest records the posts as done (see ExportRun.handle_result).
+class DirectorySink:
+    def __init__(self):
+        self.written = [] # Files written since the last sync, including those that worker processes wrote
+
+    def write(self, path, data):
+        tmp_path = temp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.written.append(str(path))
+
+    def copy(self, source, ref, path, link_mode='copy'):
+        mode = source.copy(ref, path, link_mode)
+        self.written.append(str(path))
+        return mode
+
+    def link(self, earlier_path, path, link_mode='copy'):
+        mode = link_file(earlier_path, path, link_mode)
+        self.written.append(str(path))
+        return mode
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def size(self, path):
+        return os.path.getsize(path)
+
+    # Function to flush the files written since the last sync to disk: an fsync for every file, then one for every
+    # folder they were renamed into, so their names are on disk as well. This runs once per batch of posts, so
+    # the writes of a batch are flushed together. Windows can not open folders, so there only the files are synced
+    # (and it needs a handle with write access for an fsync).
+    def sync(self):
+        flags = os.O_RDWR | os.O_BINARY if os.name == 'nt' else os.O_RDONLY
+        folders = set()
+        for path in self.written:
+            fd = os.open(path, flags)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            folders.add(os.path.dirname(path) or '.')
+        if os.name != 'nt':
+            for folder in sorted(folders):
+                fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        self.written.clear()
+
+    def close(self):
+        pass
+
+# Outputs of a worker process, kept in memory and returned with the result of the job
+# The process that runs the export adds them to its archive (see ExportRun.handle_result)
+class BufferedSink:
+    def __init__(self):
+        self.files = []
+
+    def write(self, path, data):
+        self.files.append((Path(path), data))
+
+    def copy(self, source, ref, path, link_mode='copy'):
+        with source.open(ref) as f:
+            self.write(path, f.read())
+        return 'copy'
+
+# Outputs streamed into a tar archive (.tar, or .tar.gz/.tgz for a compressed one) as they are finished.
+# Members are named by their path relative to the output root (Photos/post/__processed/...), so unpacking the
+# archive in the export folder puts every file where a run without an archive would have written it.
+# The archive is written under a temporary name and only renamed when the run ends, so it is complete or absent.
+class TarSink:
+    def __init__(self, path, output_root):
+        self.path = Path(path)
+        self.output_root = Path(output_root)
+        self.sizes = {} # Sizes of the members written so far, by member name
+        compression = 'gz' if self.path.name.lower().endswith(('.tar.gz', '.tgz')) else ''
+        self.archive = tarfile.open(str(temp_path(self.path)), f'w|{compression}')
+
+    def _name(self, path):
+        return Path(path).relative_to(self.output_root).as_posix()
+
+    def write(self, path, data):
+        info = tarfile.TarInfo(self._name(path))
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0o644
+        self.archive.addfile(info, io.BytesIO(data))
+        self.sizes[info.name] = len(data)
+
+    # Outputs of duplicate posts are stored as hard links to the earlier member, whatever the link mode
+    def link(self, earlier_path, path, link_mode='copy'):
+        info = tarfile.TarInfo(self._name(path))
+        info.type = tarfile.LNKTYPE
+        info.linkname = self._name(earlier_path)
+        info.mtime = time.time()
+        info.mode = 0o644
+        self.archive.addfile(info)
+        self.sizes[info.name] = self.sizes[info.linkname]
+        return 'hardlink'
+
+    def exists(self, path):
+        return self._name(path) in self.sizes
+
+    def size(self, path):
+        return self.sizes[self._name(path)]
+
+    def sync(self):
+        pass
+
+    # An exception on its way out (e.g. Ctrl+C) leaves the archive under its temporary name
+    def close(self):
+        self.archive.close()
+        if sys.exc_info()[0] is None:
+            os.replace(temp_path(self.path), self.path)
+
+# Outputs streamed into a ZIP archive, like TarSink. The images are compressed already, so members are stored as
+# they are. ZIP has no links, so the outputs of duplicate posts are stored again (read back from the archive).
+class ZipSink:
+    def __init__(self, path, output_root):
+        self.path = Path(path)
+        self.output_root = Path(output_root)
+        self.archive = zipfile.ZipFile(temp_path(self.path), 'w', zipfile.ZIP_STORED)
+
+    def _name(self, path):
+        return Path(path).relative_to(self.output_root).as_posix()
+
+    def write(self, path, data):
+        self.archive.writestr(self._name(path), data)
+
+    def link(self, earlier_path, path, link_mode='copy'):
+        self.archive.writestr(self._name(path), self.archive.read(self._name(earlier_path)))
+        return 'copy'
+
+    def exists(self, path):
+        return self._name(path) in self.archive.NameToInfo
+
+    def size(self, path):
+        return self.archive.getinfo(self._name(path)).file_size
+
+    def sync(self):
+        pass
+
+    # An exception on its way out (e.g. Ctrl+C) leaves the archive under its temporary name
+    def close(self):
+        self.archive.close()
+        if sys.exc_info()[0] is None:
+            os.replace(temp_path(self.path), self.path)
+
+# Function to open the sink for the outputs of an export: its archive if one is set, otherwise the output folders
+def open_sink(settings):
+    if settings['archive'] is None:
+        return DirectorySink()
+    if Path(settings['archive']).suffix.lower() == '.zip':
+        return ZipSink(settings['archive'], settings['output_root'])
+    return TarSink(settings['archive'], settings['output_root'])
+
+# Function to decode an image once, so its pixels can be reused for the singular and combined output
+def decode_image(source, image_path, data=None):
+    with (io.BytesIO(data) if data is not None else source.open(image_path)) as f:
+        img = Image.open(f)
+        try:
+            img.load()
+        except Exception:
+            img.close()
+            raise
+    return img
+
+# Encoder profiles for converted and combined images: output format, file extension and encoder options
+# (quality, chroma subsampling with 0 = 4:4:4 and 2 = 4:2:0, Huffman optimization, progressive scan).
+# size_ratio is the typical output size relative to the source WebP (measured with benchmark/compare-profiles.py
+# on a synthetic export); it is only used to estimate the bytes written in a plan.
+ENCODER_PROFILES = {
+    # Baseline JPEG, as written by earlier versions
+    'jpeg': {'format': 'JPEG', 'extension': '.jpg', 'options': {'quality': 80}, 'size_ratio': 1.3},
+    # Same pixels as 'jpeg', with optimized Huffman tables for smaller files
+    'jpeg-optimized': {'format': 'JPEG', 'extension': '.jpg', 'options': {'quality': 80, 'optimize': True}, 'size_ratio': 1.25},
+    'jpeg-progressive': {'format': 'JPEG', 'extension': '.jpg', 'options': {'quality': 80, 'optimize': True, 'progressive': True}, 'size_ratio': 1.2},
+    # Higher quality without chroma subsampling, for archiving
+    'jpeg-archive': {'format': 'JPEG', 'extension': '.jpg', 'options': {'quality': 92, 'subsampling': 0, 'optimize': True}, 'size_ratio': 2.7},
+    'webp': {'format': 'WEBP', 'extension': '.webp', 'options': {'quality': 80, 'method': 4}, 'size_ratio': 0.9},
+    'avif': {'format': 'AVIF', 'extension': '.avif', 'options': {'quality': 60, 'speed': 6}, 'size_ratio': 0.65},
+}
+default_profile = 'jpeg'
+
+# Function to encode a decoded image with an encoder profile, writing the metadata in the same pass
+# JPEG gets EXIF and IPTC (an APP13 segment, which only JPEG has); WebP and AVIF get EXIF and XMP
+def save_image(img, output_path, metadata, profile=None):
+    profile = profile or ENCODER_PROFILES[default_profile]
+    icc_profile = img.info.get('icc_profile')
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    options = dict(profile['options'], exif=metadata['exif'])
+    if icc_profile:
+        options['icc_profile'] = icc_profile
+    if profile['format'] == 'JPEG':
+        options['extra'] = metadata['iptc']
     else:
-        # If it's not a .webp file, return the original path and False for conversion status
-        return image_path, False
+        options['xmp'] = metadata['xmp']
+    img.save(output_path, profile['format'], **options)
 
 # Helper function to convert latitude and longitude to EXIF-friendly format
 def _convert_to_degrees(value):
@@ -167,383 +600,2313 @@ def _convert_to_degrees(value):
 
     return (d, m, s)
 
-# Function to update EXIF data
-def update_exif(image_path, datetime_original, location=None, caption=None):
-    try:
-        exif_dict = piexif.load(image_path.as_posix())
-
-        # Ensure the '0th' and 'Exif' directories are initialized
-        if '0th' not in exif_dict:
-            exif_dict['0th'] = {}
-        if 'Exif' not in exif_dict:
-            exif_dict['Exif'] = {}
-
-        # Update datetime original
-        exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = datetime_original.strftime("%Y:%m:%d %H:%M:%S")
-        datetime_print = datetime_original.strftime("%Y:%m:%d %H:%M:%S")
-        # logging.info(f"Found datetime: {datetime_print}") # Can be verbose
-        # logging.info(f"Added capture date and time.") # Can be verbose
-
-        # Update GPS information if location is provided
-        if location and 'latitude' in location and 'longitude' in location:
-            # logging.info(f"Found location: {location}") # Can be verbose
-            gps_ifd = {
-                piexif.GPSIFD.GPSLatitudeRef: 'N' if location['latitude'] >= 0 else 'S',
-                piexif.GPSIFD.GPSLatitude: _convert_to_degrees(abs(location['latitude'])),
-                piexif.GPSIFD.GPSLongitudeRef: 'E' if location['longitude'] >= 0 else 'W',
-                piexif.GPSIFD.GPSLongitude: _convert_to_degrees(abs(location['longitude'])),
-            }
-            exif_dict['GPS'] = gps_ifd
-            # logging.info(f"Added GPS location.") # Can be verbose
-
-        # Transfer caption as title in ImageDescription
-        if caption:
-            # logging.info(f"Found caption: {caption}") # Can be verbose
-            exif_dict['0th'][piexif.ImageIFD.ImageDescription] = caption.encode('utf-8')
-            # logging.info(f"Updated title with caption.") # Can be verbose
-        
-        exif_bytes = piexif.dump(exif_dict)
-        piexif.insert(exif_bytes, image_path.as_posix())
-        logging.info(f"Updated EXIF data for {image_path}.")
-        
-    except Exception as e:
-        logging.error(f"Failed to update EXIF data for {image_path}: {e}")
+# Function to build EXIF data in memory
+def build_exif(datetime_original, location=None, caption=None):
+    exif_dict = {'0th': {}, 'Exif': {}, 'GPS': {}}
+
+    # Set datetime original
+    exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = datetime_original.strftime("%Y:%m:%d %H:%M:%S")
+
+    # Set GPS information if location is provided
+    if location and 'latitude' in location and 'longitude' in location:
+        exif_dict['GPS'] = {
+            piexif.GPSIFD.GPSLatitudeRef: 'N' if location['latitude'] >= 0 else 'S',
+            piexif.GPSIFD.GPSLatitude: _convert_to_degrees(abs(location['latitude'])),
+            piexif.GPSIFD.GPSLongitudeRef: 'E' if location['longitude'] >= 0 else 'W',
+            piexif.GPSIFD.GPSLongitude: _convert_to_degrees(abs(location['longitude'])),
+        }
+
+    # Transfer caption as title in ImageDescription
+    if caption:
+        exif_dict['0th'][piexif.ImageIFD.ImageDescription] = caption.encode('utf-8')
+
+    return piexif.dump(exif_dict)
+
+# Function to build the IPTC information as an APP13 segment in memory
+# The IIM datasets are packed here, in the same layout as iptcinfo3 writes them, without a shared record:
+# every call builds its own bytes, so the threads of the pipeline can build metadata at the same time.
+def build_iptc(caption):
+    # Record version 4, then the "Caption-Abstract" (left out if there is none) and the static IPTC tags
+    iim = [struct.pack('!BBBHH', 0x1c, 2, 0, 2, 4)]
+    for dataset, value in [(120, caption), (115, source_app), (65, processing_tool)]:
+        if value:
+            value = value.encode('utf-8')
+            iim.append(struct.pack('!BBBH', 0x1c, 2, dataset, len(value)) + value)
+    iim = b''.join(iim)
+
+    # Wrap the IIM data in a Photoshop image resource (8BIM 0x0404), padded to an even length
+    resource = b'Photoshop 3.0\x00' + b'8BIM' + struct.pack('!HBBL', 0x0404, 0, 0, len(iim)) + iim + b'\x00' * (len(iim) % 2)
+    return struct.pack('!BBH', 0xff, 0xed, len(resource) + 2) + resource
+
+# Function to convert latitude and longitude to the XMP GPS format ("DDD,MM.mmmmmmR")
+def _xmp_coordinate(value, positive_ref, negative_ref):
+    ref = positive_ref if value >= 0 else negative_ref
+    value = abs(value)
+    degrees = int(value)
+    minutes = (value - degrees) * 60
+    return f"{degrees},{minutes:.6f}{ref}"
+
+# Function to escape text for XML, like xml.sax.saxutils.escape (which imports urllib and takes longer to load than a plan)
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+# Function to build an XMP packet in memory, with the same values as the EXIF and IPTC data
+def build_xmp(datetime_original, location=None, caption=None):
+    properties = [
+        f"<exif:DateTimeOriginal>{datetime_original.strftime('%Y-%m-%dT%H:%M:%S')}</exif:DateTimeOriginal>",
+        f"<xmp:CreateDate>{datetime_original.strftime('%Y-%m-%dT%H:%M:%S')}</xmp:CreateDate>",
+        f"<photoshop:DateCreated>{datetime_original.strftime('%Y-%m-%dT%H:%M:%S')}</photoshop:DateCreated>",
+        f"<photoshop:Source>{escape(source_app)}</photoshop:Source>",
+        f"<xmp:CreatorTool>{escape(processing_tool)}</xmp:CreatorTool>",
+    ]
+    if location and 'latitude' in location and 'longitude' in location:
+        properties.append(f"<exif:GPSLatitude>{_xmp_coordinate(location['latitude'], 'N', 'S')}</exif:GPSLatitude>")
+        properties.append(f"<exif:GPSLongitude>{_xmp_coordinate(location['longitude'], 'E', 'W')}</exif:GPSLongitude>")
+    if caption:
+        properties.append(f"<dc:description><rdf:Alt><rdf:li xml:lang=\"x-default\">{escape(caption)}</rdf:li></rdf:Alt></dc:description>")
+
+    xmp = (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+        '<rdf:Description rdf:about=""'
+        ' xmlns:dc="http://purl.org/dc/elements/1.1/"'
+        ' xmlns:exif="http://ns.adobe.com/exif/1.0/"'
+        ' xmlns:photoshop="http://ns.adobe.com/photoshop/1.0/"'
+        ' xmlns:xmp="http://ns.adobe.com/xap/1.0/">\n'
+        + "\n".join(properties) + "\n"
+        '</rdf:Description>\n'
+        '</rdf:RDF>\n'
+        '</x:xmpmeta>\n'
+        '<?xpacket end="w"?>'
+    )
+    return xmp.encode('utf-8')
+
+# Function to build all metadata for one post, shared by its primary, secondary and combined image
+def build_metadata(datetime_original, location=None, caption=None, telemetry=None):
+    telemetry = telemetry or Telemetry()
+    metadata = {}
+    with telemetry.stage('exif'):
+        metadata['exif'] = build_exif(datetime_original, location, caption)
+    with telemetry.stage('iptc'):
+        metadata['iptc'] = build_iptc(caption)
+    with telemetry.stage('xmp'):
+        metadata['xmp'] = build_xmp(datetime_original, location, caption)
+    return metadata
+
+# Functions to add metadata to a WebP file without transcoding it
+# A WebP file is a RIFF container of chunks; metadata lives in EXIF and XMP chunks next to the
+# VP8/VP8L bitstream and is announced by flags in a VP8X header chunk. Only chunk headers are
+# rewritten here, the image data is copied as it is.
+WEBP_FLAG_ALPHA = 0x10
+WEBP_FLAG_EXIF = 0x08
+WEBP_FLAG_XMP = 0x04
+
+def _webp_chunks(data):
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        raise ValueError("Not a WebP file")
+    chunks = []
+    offset = 12
+    while offset + 8 <= len(data):
+        fourcc = data[offset:offset + 4]
+        size = struct.unpack('<I', data[offset + 4:offset + 8])[0]
+        chunks.append((fourcc, data[offset + 8:offset + 8 + size]))
+        offset += 8 + size + (size & 1) # Chunks are padded to an even size
+    return chunks
+
+def _webp_canvas(chunks):
+    for fourcc, payload in chunks:
+        if fourcc == b'VP8 ':
+            # Lossy bitstream: 14-bit width and height follow the frame tag and start code
+            width, height = struct.unpack('<HH', payload[6:10])
+            return width & 0x3FFF, height & 0x3FFF, False
+        if fourcc == b'VP8L':
+            # Lossless bitstream: 14-bit width-1, 14-bit height-1 and the alpha hint after the signature byte
+            bits = struct.unpack('<I', payload[1:5])[0]
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, bool((bits >> 28) & 1)
+    raise ValueError("WebP file has no image data")
+
+def _webp_chunk(fourcc, payload):
+    return fourcc + struct.pack('<I', len(payload)) + payload + (b'\x00' if len(payload) & 1 else b'')
+
+def add_webp_metadata(data, exif=None, xmp=None):
+    chunks = _webp_chunks(data)
+
+    # Files in the simple format get a VP8X header so they can carry metadata chunks
+    if chunks[0][0] == b'VP8X':
+        vp8x = bytearray(chunks[0][1])
+        chunks = chunks[1:]
+    else:
+        width, height, alpha = _webp_canvas(chunks)
+        vp8x = bytearray(10)
+        vp8x[0] = WEBP_FLAG_ALPHA if alpha else 0
+        vp8x[4:7] = (width - 1).to_bytes(3, 'little')
+        vp8x[7:10] = (height - 1).to_bytes(3, 'little')
+
+    # Replace any existing EXIF and XMP chunks; they belong after the image data
+    chunks = [(fourcc, payload) for fourcc, payload in chunks if fourcc not in (b'EXIF', b'XMP ')]
+    if exif:
+        if exif.startswith(b'Exif\x00\x00'):
+            exif = exif[6:] # WebP stores the bare TIFF structure, without the JPEG APP1 prefix
+        chunks.append((b'EXIF', exif))
+        vp8x[0] |= WEBP_FLAG_EXIF
+    if xmp:
+        chunks.append((b'XMP ', xmp))
+        vp8x[0] |= WEBP_FLAG_XMP
+
+    body = b'WEBP' + _webp_chunk(b'VP8X', bytes(vp8x)) + b''.join(_webp_chunk(fourcc, payload) for fourcc, payload in chunks)
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+# Output filenames that are taken, by files of an earlier run or by names reserved during this run
+# The output folders are listed once with os.scandir, so naming never has to probe the disk
+class OutputNames:
+    def __init__(self, folders):
+        self.taken = set()
+        self.next_counter = {}  # Next suffix to try for each planned name
+        self.collisions = 0  # Names that were taken and got a _1, _2, ... suffix
+        for folder in folders:
+            try:
+                with os.scandir(folder) as entries:
+                    self.taken.update(folder / entry.name for entry in entries)
+            except FileNotFoundError:
+                pass
 
-# Function to update IPTC information
-def update_iptc(image_path_str, caption): # Expects a string path
-    try:
-        # Load the IPTC data from the image
-        info = IPTCInfo(image_path_str, force=True)  # Use force=True to create IPTC data if it doesn't exist
-        
-        # Check for errors (known issue with iptcinfo3 creating _markers attribute error)
-        if not hasattr(info, '_markers'):
-            info._markers = [] # type: ignore
-        
-        # Update the "Caption-Abstract" field
-        if caption:
-            info['caption/abstract'] = caption
-            # logging.info(f"Caption added to image for IPTC.") # Can be verbose
-
-        # Add static IPTC tags and keywords
-        info['source'] = source_app
-        info['originating program'] = processing_tool
-
-        # Save the changes back to the image
-        info.save_as(image_path_str)
-        logging.info(f"Updated IPTC data for {image_path_str}")
-    except Exception as e:
-        logging.error(f"Failed to update IPTC data for {image_path_str}: {e}")
+    def __contains__(self, path):
+        return path in self.taken
 
+    def add(self, path):
+        self.taken.add(path)
 
 # Function to handle deduplication
-def get_unique_filename(path):
-    if not path.exists():
-        return path
-    else:
-        prefix = path.stem
-        suffix = path.suffix
-        counter = 1
-        new_name_path = path
-        while new_name_path.exists():
-            new_name_path = new_name_path.with_name(f"{prefix}_{counter}{suffix}")
-            counter += 1
-        return new_name_path
-
-def combine_images_with_resizing(primary_path, secondary_path):
+# Names handed out during this run are tracked in `reserved`, so output names can be
+# planned up front (before any worker writes a file) without two entries racing for one name.
+# The counter continues where the last collision on the same name stopped instead of trying _1, _2, ... again.
+def get_unique_filename(path, reserved):
+    new_name_path = path
+    counter = reserved.next_counter.get(path, 1)
+    while new_name_path in reserved:
+        new_name_path = path.with_name(f"{path.stem}_{counter}{path.suffix}")
+        counter += 1
+    reserved.next_counter[path] = counter
+    if new_name_path != path:
+        reserved.collisions += 1
+    reserved.add(new_name_path)
+    return new_name_path
+
+# Function to compute the size of the secondary image when placed on top of the primary image
+def secondary_overlay_size(size, scale=secondary_scaling_factor):
+    width, height = size
+    return int(width * scale), int(height * scale)
+
+# Function to resize the secondary image using LANCZOS resampling for better quality
+def resize_secondary(secondary_image, full_size=None, scale=secondary_scaling_factor):
+    return secondary_image.resize(secondary_overlay_size(full_size or secondary_image.size, scale), Image.Resampling.LANCZOS)
+
+# Function to decode a secondary image that is only needed for the combined image, scaled to the overlay size
+# JPEG files are decoded at reduced size with draft mode (1/2, 1/4 or 1/8 scale, never below the target);
+# Pillow has no scaled decoding for WebP, so those are decoded at full size. The final resize is done with LANCZOS.
+def decode_secondary_overlay(source, image_path, data=None, scale=secondary_scaling_factor):
+    with (io.BytesIO(data) if data is not None else source.open(image_path)) as f:
+        img = Image.open(f)
+        try:
+            full_size = img.size
+            if img.format == 'JPEG':
+                img.draft('RGB', secondary_overlay_size(full_size, scale))
+            img.load()
+            return resize_secondary(img, full_size, scale)
+        finally:
+            img.close()
+
+# Function to combine the already decoded primary and secondary image (the caller closes both)
+def combine_images_with_resizing(primary_image, secondary_image, style=None):
+    style = style or default_combined_style
+    resized_secondary_image = resize_secondary(secondary_image, scale=style['scale'])
+    try:
+        return combine_images(primary_image, resized_secondary_image, style)
+    finally:
+        resized_secondary_image.close()
+
+# Function to get the path of a thumbnail in the folder next to the output folders,
+# e.g. Photos/post/__thumbnails/512/__processed/<name of the output file>
+def thumbnail_path(output_path, size, extension):
+    output_path = Path(output_path)
+    return output_path.parent.parent / thumbnails_folder.name / str(size) / output_path.parent.name / (output_path.stem + extension)
+
+# Function to create downscaled renditions of a decoded image, with `sizes` as the length of the long edge
+# Renditions are made largest first, each one reduced from the previous one rather than from the full image.
+# Images that are already smaller than a size are not enlarged.
+def make_thumbnails(img, sizes):
+    thumbnails = {}
+    current = img
+    for size in sorted(sizes, reverse=True):
+        scale = size / max(img.size)
+        target = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        if scale < 1 and target != current.size:
+            current = current.resize(target, Image.Resampling.LANCZOS)
+            thumbnails[size] = current
+        else:
+            # Same pixels as the image or the previous size; every size gets its own copy, because
+            # the caller closes each thumbnail after encoding it (and the image independently of them)
+            thumbnails[size] = current.copy()
+    return thumbnails
+
+# Function to draw the masks for a secondary image of `size`: its rounded corners, and the rounded outline
+# around it (which is `outline_size` larger on every side). BeReal images nearly always have the same size,
+# so the masks are drawn once and reused for every combined image.
+@functools.lru_cache(maxsize=16)
+def overlay_masks(size, corner_radius, outline_size):
+    width, height = size
+    mask = Image.new('L', size, 0)
+    ImageDraw.Draw(mask).rounded_rectangle((0, 0, width, height), corner_radius, fill=255)
+    # rounded_rectangle includes the end coordinates, so the outline needs one more pixel in each direction
+    outline_mask = Image.new('L', (width + 2 * outline_size + 1, height + 2 * outline_size + 1), 0)
+    ImageDraw.Draw(outline_mask).rounded_rectangle((0, 0, width + 2 * outline_size, height + 2 * outline_size),
+                                                   corner_radius + outline_size, fill=255)
+    return mask, outline_mask
+
+# Function to place the already resized secondary image on top of the primary image
+# Only the region under the overlay is touched: the outline and the secondary image are pasted through
+# the cached masks, so the cost of compositing depends on the size of the overlay, not of the frame.
+def combine_images(primary_image, resized_secondary_image, style=None):
     # Parameters for rounded corners, outline and position
-    corner_radius = 60
-    outline_size = 7
-    position = (55, 55)
+    style = style or default_combined_style
+    corner_radius = style['corner_radius']
+    outline_size = style['outline_size']
+    position = tuple(style['position'])
 
-    # Load primary and secondary images
-    # Ensure paths are strings for Image.open, though Path objects are usually fine
-    primary_image = Image.open(str(primary_path))
-    secondary_image = Image.open(str(secondary_path))
+    mask, outline_mask = overlay_masks(resized_secondary_image.size, corner_radius, outline_size)
 
+    # Start from a copy of the primary image
+    combined_image = primary_image.convert('RGB') if primary_image.mode != 'RGB' else primary_image.copy()
 
-    # Resize the secondary image using LANCZOS resampling for better quality
-    scaling_factor = 1/3.33333333  
-    width, height = secondary_image.size
-    new_width = int(width * scaling_factor)
-    new_height = int(height * scaling_factor)
-    resized_secondary_image = secondary_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-    # Ensure secondary image has an alpha channel for transparency
-    if resized_secondary_image.mode != 'RGBA':
-        resized_secondary_image = resized_secondary_image.convert('RGBA')
+    # Draw the black outline with rounded corners directly on the combined image
+    combined_image.paste((0, 0, 0), (position[0] - outline_size, position[1] - outline_size), outline_mask)
 
-    # Create mask for rounded corners
-    mask = Image.new('L', (new_width, new_height), 0)
-    draw_mask = ImageDraw.Draw(mask) # Use a different variable name for the Draw object
-    draw_mask.rounded_rectangle((0, 0, new_width, new_height), corner_radius, fill=255)
+    # Paste the secondary image onto the combined image, with the rounded corners mask as its transparency
+    if resized_secondary_image.mode != 'RGB':
+        secondary_rgb = resized_secondary_image.convert('RGB')
+        combined_image.paste(secondary_rgb, position, mask)
+        secondary_rgb.close()
+    else:
+        combined_image.paste(resized_secondary_image, position, mask)
 
-    # Apply the rounded corners mask to the secondary image
-    resized_secondary_image.putalpha(mask)
+    return combined_image
 
-    # Create a new blank image with the size of the primary image
-    combined_image = Image.new("RGB", primary_image.size)
-    combined_image.paste(primary_image, (0, 0))    
+# Persistent cache of decoded frames for re-rendering combined images (see restyle_entry): the full primary image
+# and the scaled secondary image of every post, keyed by the SHA-256 of the source file (and the scale). Frames are
+# stored as raw pixels (after a header line and the ICC profile), so loading one costs a file read instead of a decode. Files are evicted least recently used
+# first (by modification time, which is updated on every hit) once the cache is larger than `max_bytes`.
+class RenderCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
 
-    # Draw the black outline with rounded corners directly on the combined image
-    outline_layer = Image.new('RGBA', combined_image.size, (0, 0, 0, 0))  # Transparent layer for drawing the outline
-    draw_outline = ImageDraw.Draw(outline_layer) # Use a different variable name
-    outline_box = [position[0] - outline_size, position[1] - outline_size, position[0] + new_width + outline_size, position[1] + new_height + outline_size]
-    draw_outline.rounded_rectangle(outline_box, corner_radius + outline_size, fill=(0, 0, 0, 255))
-
-    # Merge the outline layer with the combined image
-    combined_image.paste(outline_layer, (0, 0), outline_layer)
-
-    # Paste the secondary image onto the combined image using its alpha channel as the mask
-    combined_image.paste(resized_secondary_image, position, resized_secondary_image)
-    
-    primary_image.close()
-    secondary_image.close()
-    resized_secondary_image.close()
-    mask.close()
-    outline_layer.close()
+    def _path(self, key):
+        return self.folder / f"{key}.raw"
 
-    return combined_image
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                mode, width, height, icc_length = f.readline().split()
+                icc_profile = f.read(int(icc_length))
+                data = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path) # Mark as recently used
+        img = Image.frombytes(mode.decode('ascii'), (int(width), int(height)), data)
+        if icc_profile:
+            img.info['icc_profile'] = icc_profile
+        return img
+
+    # Function to store a frame; returns the number of bytes written
+    def put(self, key, img):
+        path = self._path(key)
+        icc_profile = img.info.get('icc_profile') or b''
+        header = f"{img.mode} {img.width} {img.height} {len(icc_profile)}\n".encode('ascii')
+        data = img.tobytes()
+        tmp_path = temp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(icc_profile)
+            f.write(data)
+        os.replace(tmp_path, path)
+        return len(header) + len(icc_profile) + len(data)
+
+    def evict(self):
+        try:
+            with os.scandir(self.folder) as entries:
+                files = [(entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in entries if entry.name.endswith('.raw')]
+        except FileNotFoundError:
+            return
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+
+# Function to get the render cache of an export, or None if it is turned off
+def open_render_cache(settings):
+    if not settings['render_cache_mb']:
+        return None
+    return RenderCache(settings['output_root'] / render_cache_folder, settings['render_cache_mb'] * 1e6)
+
+# Functions to get the cache keys of the primary frame and of the secondary image scaled for the overlay
+def primary_cache_key(sha256):
+    return f"{sha256}-full"
+
+def overlay_cache_key(sha256, scale):
+    return f"{sha256}-{scale:.6f}"
+
+# Function to fingerprint a source file, so later runs can tell whether it changed
+def file_sha256(source, path):
+    digest = hashlib.sha256()
+    with source.open(path) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The hash is only computed from the file if it is not already known
+def source_fingerprint(source, path, sha256=None):
+    size, mtime_ns = source.stat(path)
+    return {'size': size, 'mtime_ns': mtime_ns, 'sha256': sha256 or file_sha256(source, path)}
+
+# Persistent record of processed entries, so interrupted or repeated runs only process new or changed posts
+# Stored as JSON lines in the output folder; the last line written for a post wins
+# A read-only manifest (used for plans) is loaded as it is and only updated in memory. Without a path
+# (for archives, which are written complete in every run) the manifest starts empty and stays in memory.
+class Manifest:
+    def __init__(self, path, read_only=False):
+        self.path = Path(path) if path is not None else None
+        self.records = {}
+        if self.path is not None and self.path.exists():
+            with open(self.path, encoding="utf8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.records[record['post']] = record
+                    except (ValueError, KeyError):
+                        continue # Skip a line cut short by an interrupted run
+            # Compact the file to one line per post
+            if not read_only:
+                tmp_path = self.path.with_name(self.path.name + '.tmp')
+                with open(tmp_path, 'w', encoding="utf8") as f:
+                    for record in self.records.values():
+                        f.write(json.dumps(record) + "\n")
+                os.replace(tmp_path, self.path)
+        self.previous = dict(self.records) # Records of earlier runs; records appended during this run are not in here
+        self.file = None if read_only or self.path is None else open(self.path, 'a', encoding="utf8")
+
+    # Function to get the record an earlier run left for a post
+    def get(self, post):
+        return self.previous.get(post)
+
+    def append(self, record):
+        self.records[record['post']] = record
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    # Settings that determine the outputs of a post, besides its entry and source files; they are recorded with every post
+    @staticmethod
+    def output_settings(settings):
+        recorded = {name: settings[name] for name in ['convert_to_jpeg', 'keep_original_filename', 'create_combined_images', 'encoder_profile', 'thumbnail_sizes']}
+        # The default look is left out, so the manifests of runs from before the style settings stay valid
+        if settings['create_combined_images'] == 'yes' and settings['combined_style'] != default_combined_style:
+            recorded['combined_style'] = settings['combined_style']
+        return recorded
+
+    # Digest of everything that determines the outputs of a post besides its source files
+    @staticmethod
+    def digest(entry, settings):
+        key = {'entry': entry, 'settings': Manifest.output_settings(settings)}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # Check whether a post was completed with the same entry, settings and source files
+    @staticmethod
+    def is_up_to_date(record, digest, source, sources):
+        if record is None or record['status'] != 'done' or record['digest'] != digest:
+            return False
+        if not all(Path(output).exists() for output in record['outputs'].values()):
+            return False
+        for role, path in sources.items():
+            fingerprint = record['sources'][role]
+            size, mtime_ns = source.stat(path)
+            if size != fingerprint['size']:
+                return False
+            # A different mtime alone (e.g. a fresh unzip) is fine as long as the content is the same
+            if mtime_ns != fingerprint['mtime_ns'] and file_sha256(source, path) != fingerprint['sha256']:
+                return False
+        return True
+
+# Processing of one posts.json entry is split into stages, so the pipeline (see run_pipeline) can overlap them:
+# read the source images, decode and transform them, encode the outputs and write them.
+# Each stage works on the same `work` dict; process_entry runs the stages one after another.
+
+# Function to create the work item of an entry
+def new_work(job, settings):
+    return {
+        'job': job,
+        'telemetry': Telemetry(trace=settings['trace']),
+        'result': new_result(),
+        'data': {}, # Source file contents
+        'sha256': {}, # Hashes of the sources, computed from the data that was read anyway
+        'images': {}, # Decoded images that still have to be encoded
+        'thumbnails': {}, # Downscaled renditions by (output name, size) that still have to be encoded
+        'encoded_thumbnails': {},
+        'encoded': {}, # Output file contents
+        'copies': [], # Roles whose source file is copied (or linked) as it is
+        'failed': set(), # Roles that could not be processed
+        'aborted': False,
+        # Outputs for an archive are returned with the result and added to the archive by the main process
+        'sink': BufferedSink() if settings['archive'] else DirectorySink(),
+    }
+
+# Function to read the source images of an entry into memory
+def read_entry(work, settings):
+    source = settings['source']
+    job, result, telemetry = work['job'], work['result'], work['telemetry']
+    for role in ['primary', 'secondary']:
+        path_current = job[f'{role}_path']
+        logging.debug(f"Processing {role} image: {path_current}")
+        # Files that are neither converted, tagged, combined nor thumbnailed are copied straight from the source when writing
+        if (settings['convert_to_jpeg'] != 'yes' and path_current.suffix.lower() != '.webp'
+                and settings['create_combined_images'] != 'yes' and not settings['thumbnail_sizes']):
+            continue
+        try:
+            with telemetry.stage('read'):
+                with source.open(path_current) as f:
+                    work['data'][role] = f.read()
+        except Exception as e:
+            logging.error(f"Error reading {path_current}: {e}")
+            result['skipped'] += 1
+            work['failed'].add(role)
+            continue
+        telemetry.add_bytes('read', len(work['data'][role]))
+        with telemetry.stage('fingerprint'):
+            work['sha256'][role] = hashlib.sha256(work['data'][role]).hexdigest()
+
+# Function to decode the source images of an entry, add metadata to WebP copies and build the combined image
+# Each source image is decoded once; its pixels feed both the singular output and the combined image
+def decode_entry(work, settings):
+    source = settings['source']
+    job, result, telemetry, images = work['job'], work['result'], work['telemetry'], work['images']
+    convert = settings['convert_to_jpeg'] == 'yes'
+    create_combined = settings['create_combined_images'] == 'yes'
+    work['metadata'] = metadata = build_metadata(job['taken_at'], job['location'], job['caption'], telemetry)
+
+    overlay_images = {} # Decoded only for the combined image
+    try:
+        for role in ['primary', 'secondary']:
+            if role in work['failed']:
+                continue
+            path_current = job[f'{role}_path']
+            data = work['data'].pop(role, None)
 
-# Function to clean up backup files left behind by iptcinfo3
-def remove_backup_files(directory):
-    # List all files in the given directory
-    for filename in os.listdir(directory):
-        # Check if the filename ends with '~'
-        if filename.endswith('~'):
-            # Construct the full path to the file
-            file_path = os.path.join(directory, filename)
+            if convert:
+                # Decode once; the JPEG is written once, with EXIF and IPTC in the same pass
+                try:
+                    with telemetry.stage('decode'):
+                        images[role] = decode_image(source, path_current, data)
+                except Exception as e:
+                    logging.error(f"Error converting {path_current} to JPEG: {e}")
+                    result['skipped'] += 1
+                    logging.error(f"Skipping {path_current} due to conversion error.")
+                    work['failed'].add(role)
+                continue # Skip this specific file (primary or secondary)
+
+            if path_current.suffix.lower() == '.webp': # Not converting, so copy the WebP with metadata added to its header
+                try:
+                    with telemetry.stage('webp'):
+                        work['encoded'][role] = add_webp_metadata(data, metadata['exif'], metadata['xmp'])
+                except Exception as e:
+                    logging.error(f"Failed to add metadata to {path_current}, copying it unchanged: {e}")
+                    work['encoded'][role] = data
+            else: # Not converting, so copy (or link) the original file
+                work['copies'].append(role)
+
+            if create_combined or settings['thumbnail_sizes']:
+                try:
+                    with telemetry.stage('decode'):
+                        # The secondary image is only shown scaled down, so a JPEG can be decoded at reduced size
+                        # (unless its thumbnails are needed as well)
+                        if role == 'secondary' and not settings['thumbnail_sizes'] and path_current.suffix.lower() in ('.jpg', '.jpeg'):
+                            overlay_images['secondary_overlay'] = decode_secondary_overlay(source, path_current, data, settings['combined_style']['scale'])
+                        else:
+                            overlay_images[role] = decode_image(source, path_current, data)
+                except Exception as e:
+                    logging.error(f"Failed to decode {path_current} for the combined image: {e}")
+
+        # Create the combined image from the pixels decoded above
+        if create_combined:
+            decoded = dict(overlay_images, **images)
+            if 'primary' in decoded and ('secondary' in decoded or 'secondary_overlay' in decoded):
+                try:
+                    with telemetry.stage('combine'):
+                        if 'secondary_overlay' not in decoded:
+                            overlay_images['secondary_overlay'] = resize_secondary(decoded['secondary'], scale=settings['combined_style']['scale'])
+                        images['combined'] = combine_images(decoded['primary'], overlay_images['secondary_overlay'], settings['combined_style'])
+                except Exception as e_combine:
+                    logging.error(f"Error during combined image creation for {job['combined_output']}: {e_combine}")
+                # Keep the frames, so the combined image can be re-rendered in another style without decoding again
+                render_cache = open_render_cache(settings)
+                if render_cache is not None and 'combined' in images and 'primary' in work['sha256'] and 'secondary' in work['sha256']:
+                    try:
+                        with telemetry.stage('cache'):
+                            result['cache_bytes'] += render_cache.put(primary_cache_key(work['sha256']['primary']), decoded['primary'])
+                            result['cache_bytes'] += render_cache.put(overlay_cache_key(work['sha256']['secondary'], settings['combined_style']['scale']),
+                                                                      overlay_images['secondary_overlay'])
+                    except OSError as e:
+                        logging.error(f"Could not add the frames of {job['post']} to the render cache: {e}")
+            else:
+                logging.warning("Skipping combined image creation due to a missing primary or secondary image in a pair.")
+
+        # Create the thumbnails from the decoded pixels as well, so they need no decode of their own
+        if settings['thumbnail_sizes']:
+            with telemetry.stage('thumbnail'):
+                decoded = dict(overlay_images, **images)
+                for name in ['primary', 'secondary', 'combined']:
+                    if name in decoded:
+                        for size, thumbnail in make_thumbnails(decoded[name], settings['thumbnail_sizes']).items():
+                            work['thumbnails'][(name, size)] = thumbnail
+    finally:
+        for img in overlay_images.values():
+            img.close()
+
+# Function to encode the decoded images of an entry with the chosen encoder profile
+def encode_entry(work, settings):
+    job, result, telemetry, images = work['job'], work['result'], work['telemetry'], work['images']
+    for name in list(images):
+        img = images.pop(name)
+        try:
+            encoded = io.BytesIO()
+            with telemetry.stage('encode'):
+                save_image(img, encoded, work['metadata'], ENCODER_PROFILES[settings['encoder_profile']])
+            work['encoded'][name] = encoded.getvalue()
+        except Exception as e:
+            if name == 'combined':
+                logging.error(f"Error during combined image creation for {job['combined_output']}: {e}")
+            else:
+                logging.error(f"Error converting {job[f'{name}_path']} to JPEG: {e}")
+                result['skipped'] += 1
+                logging.error(f"Skipping {job[f'{name}_path']} due to conversion error.")
+                work['failed'].add(name)
+        finally:
+            img.close()
+
+    for key in list(work['thumbnails']):
+        thumbnail = work['thumbnails'].pop(key)
+        try:
+            encoded = io.BytesIO()
+            with telemetry.stage('encode'):
+                save_image(thumbnail, encoded, work['metadata'], ENCODER_PROFILES[settings['encoder_profile']])
+            work['encoded_thumbnails'][key] = encoded.getvalue()
+        except Exception as e:
+            logging.error(f"Error creating the {key[1]} px thumbnail of {job[f'{key[0]}_output']}: {e}")
+        finally:
+            thumbnail.close()
+
+# Function to write the outputs of an entry and fingerprint its sources for the manifest
+def write_entry(work, settings):
+    source = settings['source']
+    job, result, telemetry, sink = work['job'], work['result'], work['telemetry'], work['sink']
+    for role in ['primary', 'secondary']:
+        if role in work['failed']:
+            continue
+        path_current = job[f'{role}_path']
+        new_final_path = job[f'{role}_output']
+        with telemetry.stage('write'):
+            if role in work['copies']:
+                written_bytes = source.stat(path_current)[0]
+                if sink.copy(source, path_current, new_final_path, settings['link_mode']) != 'copy':
+                    result['linked_bytes'] += written_bytes
+            else:
+                data = work['encoded'].pop(role)
+                written_bytes = len(data)
+                sink.write(new_final_path, data)
+        if settings['convert_to_jpeg'] == 'yes':
+            logging.debug(f"Converted {path_current} to {new_final_path}.")
+            if path_current.suffix.lower() == '.webp':
+                result['converted'] += 1
+        telemetry.add_bytes('written', written_bytes)
+        logging.debug(f"Successfully processed {role} image to {new_final_path}")
+        result['processed'] += 1
+
+    if 'combined' in work['encoded']:
+        combined_image_final_path = job['combined_output']
+        try:
+            data = work['encoded'].pop('combined')
+            with telemetry.stage('write'):
+                sink.write(combined_image_final_path, data)
+            telemetry.add_bytes('written', len(data))
+            result['combined'] += 1
+            logging.debug(f"Combined image saved: {combined_image_final_path}")
+        except Exception as e_combine:
+            logging.error(f"Error during combined image creation for {combined_image_final_path}: {e_combine}")
+
+    for (name, size), data in work['encoded_thumbnails'].items():
+        thumbnail_output = thumbnail_path(job[f'{name}_output'], size, ENCODER_PROFILES[settings['encoder_profile']]['extension'])
+        with telemetry.stage('write'):
+            sink.write(thumbnail_output, data)
+        telemetry.add_bytes('written', len(data))
+        result['thumbnails'] += 1
+    work['encoded_thumbnails'].clear()
+
+    # Fingerprint the sources of a completed entry for the manifest
+    if result['processed'] == 2 and (settings['create_combined_images'] != 'yes' or result['combined'] == 1):
+        with telemetry.stage('fingerprint'):
+            result['sources'] = {role: source_fingerprint(source, job[f'{role}_path'], work['sha256'].get(role))
+                                 for role in ['primary', 'secondary']}
+
+# Function to run one stage on a work item; an unexpected error skips the rest of the entry
+def run_stage(stage_function, work, settings):
+    if work['aborted']:
+        return
+    try:
+        stage_function(work, settings)
+    except Exception as e:
+        logging.error(f"Error processing entry {work['job']['entry']}: {e}")
+        # Increment skipped count for both potential files in the entry if a general error occurs
+        work['result']['skipped'] += 2
+        work['aborted'] = True
+        for img in list(work['images'].values()) + list(work['thumbnails'].values()):
+            img.close()
+        work['images'].clear()
+        work['thumbnails'].clear()
+
+# Function to return the result of a finished work item
+def finish_work(work):
+    result = work['result']
+    if isinstance(work['sink'], BufferedSink):
+        result['files'] = work['sink'].files
+    else:
+        result['written'] = work['sink'].written
+    result['telemetry'] = work['telemetry'].to_dict()
+    return result
+
+# Function to process one posts.json entry (runs in a worker)
+def process_entry(job, settings):
+    if settings['verbose']:
+        logging.getLogger().setLevel(logging.DEBUG) # Worker processes started with spawn do not inherit the level
+    work = new_work(job, settings)
+    # Duplicates are linked to the outputs of the earlier post by the main process (see link_duplicate)
+    if not job.get('duplicate_of'):
+        for stage_function in [read_entry, decode_entry, encode_entry, write_entry]:
+            run_stage(stage_function, work, settings)
+    return finish_work(work)
+
+# Function to render the combined image of a post (and its thumbnails) again in the current style (runs in a worker)
+# The frames come from the render cache where possible, which leaves only compositing and encoding;
+# frames that are not cached are decoded from the sources as in a normal run, and added to the cache.
+def restyle_entry(job, settings):
+    if settings['verbose']:
+        logging.getLogger().setLevel(logging.DEBUG) # Worker processes started with spawn do not inherit the level
+    source, style = settings['source'], settings['combined_style']
+    profile = ENCODER_PROFILES[settings['encoder_profile']]
+    telemetry = Telemetry(trace=settings['trace'])
+    result = new_result()
+    sink = DirectorySink()
+    render_cache = open_render_cache(settings)
+    frames = {}
+    renditions = {} # The combined image (under None) and its thumbnails (by size)
+    try:
+        keys = {'primary': primary_cache_key(job['sha256']['primary']), 'secondary': overlay_cache_key(job['sha256']['secondary'], style['scale'])}
+        for role, key in keys.items():
+            if render_cache is not None:
+                with telemetry.stage('cache'):
+                    frames[role] = render_cache.get(key)
+                if frames[role] is not None:
+                    result['cache_hits'] += 1
+                    continue
+            with telemetry.stage('decode'):
+                if role == 'primary':
+                    frames[role] = decode_image(source, job['primary_path'])
+                else:
+                    frames[role] = decode_secondary_overlay(source, job['secondary_path'], scale=style['scale'])
+            if render_cache is not None:
+                with telemetry.stage('cache'):
+                    result['cache_bytes'] += render_cache.put(key, frames[role])
+
+        with telemetry.stage('combine'):
+            renditions[None] = combine_images(frames['primary'], frames['secondary'], style)
+        with telemetry.stage('thumbnail'):
+            renditions.update(make_thumbnails(renditions[None], settings['thumbnail_sizes']))
+        metadata = build_metadata(job['taken_at'], job['location'], job['caption'], telemetry)
+        for size, img in renditions.items():
+            encoded = io.BytesIO()
+            with telemetry.stage('encode'):
+                save_image(img, encoded, metadata, profile)
+            output_path = job['combined_output'] if size is None else thumbnail_path(job['combined_output'], size, profile['extension'])
+            with telemetry.stage('write'):
+                sink.write(output_path, encoded.getvalue())
+            telemetry.add_bytes('written', encoded.tell())
+            if size is None:
+                result['combined'] += 1
+            else:
+                result['thumbnails'] += 1
+        logging.debug(f"Combined image rendered again: {job['combined_output']}")
+        result['sources'] = job['sources']
+        result['written'] = sink.written
+    except Exception as e:
+        logging.error(f"Error rendering the combined image {job['combined_output']} again: {e}")
+        result['skipped'] += 1
+    finally:
+        for img in list(frames.values()) + list(renditions.values()):
+            if img is not None:
+                img.close()
+    result['telemetry'] = telemetry.to_dict()
+    return result
+
+# Function to run jobs on a pool of worker processes, yielding (job, result) pairs in job order
+def run_jobs(function, jobs, settings, workers):
+    for job, result in run_job_pairs(function, ((job, settings) for job in jobs), workers):
+        yield job, result
+
+# Function to run (job, settings) pairs on a pool of worker processes, yielding (job, result) pairs in job order
+# Every job brings its own settings, so jobs of different exports can share one pool (see run_batch)
+# With an order_key, results are only kept in order among the jobs with the same key (e.g. the export of a job)
+def run_job_pairs(function, pairs, workers, order_key=None):
+    if workers <= 1:
+        for job, settings in pairs:
+            yield job, function(job, settings)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep a bounded number of jobs in flight so jobs can be produced lazily. Jobs are collected as soon as any of
+        # them finishes, so one slow job does not stop new jobs from being submitted; its results wait in their queue.
+        pairs = iter(pairs)
+        waiting = {} # (job, future) in submission order, by order key
+        running = set()
+        unyielded = 0 # Jobs submitted whose result was not yielded yet, finished or not
+        exhausted = False
+        while True:
+            while not exhausted and len(running) < workers * 2 and unyielded < workers * 8:
+                pair = next(pairs, None)
+                if pair is None:
+                    exhausted = True
+                    break
+                job, settings = pair
+                future = executor.submit(function, job, settings)
+                waiting.setdefault(order_key(job) if order_key else None, deque()).append((job, future))
+                running.add(future)
+                unyielded += 1
+            for jobs in waiting.values():
+                while jobs and jobs[0][1].done():
+                    job, future = jobs.popleft()
+                    unyielded -= 1
+                    yield job, future.result()
+            if running:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            elif exhausted:
+                return
+
+# Number of images that may be in flight in the pipeline, read but not yet written
+class ImageBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, count):
+        with self.condition:
+            # A single entry is always let through, even if it needs more images than the limit
+            self.condition.wait_for(lambda: self.in_use == 0 or self.in_use + count <= self.limit)
+            self.in_use += count
+
+    def release(self, count):
+        with self.condition:
+            self.in_use -= count
+            self.condition.notify_all()
+
+# Function to run the threads of one pipeline stage: take work from input_queue, run the stage, pass it on
+def _pipeline_stage_worker(name, stage_function, settings, input_queue, output_queue, budget, stats, lock):
+    while True:
+        wait_start = time.perf_counter()
+        item = input_queue.get()
+        starved = time.perf_counter() - wait_start
+        if item is None:
+            input_queue.put(None) # Let the other threads of this stage stop as well
+            break
+        seq, work, image_count = item
+        budget_start = time.perf_counter()
+        if name == 'read':
+            budget.acquire(image_count)
+        busy_start = time.perf_counter()
+        run_stage(stage_function, work, settings)
+        busy_end = time.perf_counter()
+        if name == 'write':
+            budget.release(image_count)
+        output_queue.put(item)
+        with lock:
+            stage_stats = stats[name]
+            stage_stats['items'] += 1
+            stage_stats['busy_s'] += busy_end - busy_start
+            stage_stats['starved_s'] += starved
+            stage_stats['memory_wait_s'] += busy_start - budget_start
+            stage_stats['blocked_s'] += time.perf_counter() - busy_end
+    with lock:
+        stats[name]['running'] -= 1
+        last = stats[name]['running'] == 0
+    if last:
+        output_queue.put(None)
+
+# Function to run jobs through a pipeline of threads in this process, yielding (job, result) pairs in job order
+# Reading, decoding, encoding and writing overlap: every stage has its own threads, connected by bounded
+# queues. Pillow releases the GIL while decoding and encoding, so those stages get `threads` threads each.
+# At most `max_images` images are in flight (read but not yet written), which caps the memory used.
+# Per-stage throughput is collected in `stats`, so the bottleneck stage can be reported.
+# The stage functions run on several threads at once, so they must not change shared state: each one works only
+# on its own work item (debug/check-metadata-threads.py checks this for the metadata of concurrent posts).
+def run_pipeline(jobs, settings, threads, max_images, stats):
+    stages = [('read', read_entry, 2), ('decode', decode_entry, threads), ('encode', encode_entry, threads), ('write', write_entry, 2)]
+    queues = [queue.Queue(maxsize=threads * 2) for _ in stages] + [queue.Queue()]
+    budget = ImageBudget(max_images)
+    lock = threading.Lock()
+    start = time.perf_counter()
+    workers = []
+    for index, (name, stage_function, stage_threads) in enumerate(stages):
+        stats[name] = {'threads': stage_threads, 'running': stage_threads, 'items': 0,
+                       'busy_s': 0.0, 'starved_s': 0.0, 'memory_wait_s': 0.0, 'blocked_s': 0.0}
+        for _ in range(stage_threads):
+            worker = threading.Thread(target=_pipeline_stage_worker, daemon=True,
+                                      args=(name, stage_function, settings, queues[index], queues[index + 1], budget, stats, lock))
+            worker.start()
+            workers.append(worker)
+
+    finished = {}
+    submitted = 0
+    next_seq = 0
+    images_per_entry = 3 if settings['create_combined_images'] == 'yes' else 2
+
+    def collect(block):
+        while True:
             try:
-                # Remove the file
-                os.remove(file_path)
-                logging.info(f"Removed backup file: {file_path}")
-            except Exception as e:
-                logging.warning(f"Failed to remove backup file {file_path}: {e}")
+                item = queues[-1].get(block=block)
+            except queue.Empty:
+                return
+            if item is not None:
+                seq, work, image_count = item
+                finished[seq] = (work['job'], finish_work(work))
+            if block:
+                return
 
-# Load the JSON file
-try:
-    with open('posts.json', encoding="utf8") as f:
-        data = json.load(f)
-except FileNotFoundError:
-    logging.error("JSON file not found. Please check the path.")
-    exit()
-
-# Process files
-for entry in data:
     try:
-        # Extract only the filename from the path and then append it to the photo_folder path
-        primary_filename_str = Path(entry['primary']['path']).name
-        secondary_filename_str = Path(entry['secondary']['path']).name
-        
-        primary_path_initial = photo_folder / primary_filename_str
-        secondary_path_initial = photo_folder / secondary_filename_str
-
-        if not os.path.exists(primary_path_initial):
-            primary_path_initial = bereal_folder / primary_filename_str
-        if not os.path.exists(secondary_path_initial): # Check secondary path separately
-            secondary_path_initial = bereal_folder / secondary_filename_str
-        
-        # Check if files exist after attempting both folders
-        if not primary_path_initial.exists():
-            logging.error(f"Primary image not found: {primary_filename_str} in {photo_folder} or {bereal_folder}")
-            skipped_files_count +=1 # Count as skipped if primary is missing
-            if not secondary_path_initial.exists(): # If secondary also missing
-                 skipped_files_count +=1 # Count as skipped
-            continue # Skip this entry if primary is missing
-
-        if not secondary_path_initial.exists():
-            logging.error(f"Secondary image not found: {secondary_filename_str} in {photo_folder} or {bereal_folder}")
-            skipped_files_count +=1 # Count as skipped if secondary is missing
-            # We might still process primary if it exists, or skip. Current logic processes pair.
-            # For now, assume we need both to proceed with an "entry"
-            continue
-
-
-        taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
-        location = entry.get('location')  # This will be None if 'location' is not present
-        caption = entry.get('caption')  # This will be None if 'caption' is not present
-
-        
-        for path_current, role in [(primary_path_initial, 'primary'), (secondary_path_initial, 'secondary')]:
-            logging.info(f"Processing {role} image: {path_current}")
-            
-            # Determine the path that will be processed (original or converted)
-            path_to_process = path_current
-            converted_in_this_step = False
-
-            if convert_to_jpeg == 'yes':
-                if path_current.suffix.lower() == '.webp':
-                    converted_temp_path, converted_in_this_step = convert_webp_to_jpg(path_current)
-                    if converted_temp_path is None: # Conversion failed
-                        skipped_files_count += 1
-                        logging.error(f"Skipping {path_current} due to conversion error.")
-                        # Use continue to skip processing for this specific file (primary or secondary)
-                        # This requires restructuring how primary_images/secondary_images are paired.
-                        # For simplicity, if one file in a pair fails conversion, we might need to skip the pair for combining.
-                        # Let's assume for now we mark it and it won't be added to lists for combining if it fails.
-                        # This part of the loop might need a flag to signal to skip adding to primary_images/secondary_images.
-                        if role == 'primary': primary_images.append(None) # Placeholder for failed primary
-                        else: secondary_images.append(None) # Placeholder for failed secondary
-                        continue # Skip this specific file (primary or secondary)
-                    path_to_process = converted_temp_path # Now points to the .jpg file in the original folder
-                    if converted_in_this_step:
-                        converted_files_count += 1
-                # If already .jpg, path_to_process remains path_current, converted_in_this_step is False
-            
-            # Adjust filename based on user's choice
-            time_str = taken_at.strftime("%Y-%m-%dT%H-%M-%S")
-            original_filename_stem = Path(path_current).stem
-            
-            if convert_to_jpeg == 'yes': # Output will be JPEG
-                new_extension = '.jpg'
-                if keep_original_filename == 'yes':
-                    # If converted from webp, path_to_process.name is already .jpg. If original was .jpg, also .jpg
-                    new_filename_base = f"{time_str}_{role}_{path_to_process.stem}" 
-                else:
-                    new_filename_base = f"{time_str}_{role}"
-            else: # Output will be WebP (or original format if not WebP)
-                new_extension = path_to_process.suffix # Keep original extension if not converting to JPEG
-                if keep_original_filename == 'yes':
-                    new_filename_base = f"{time_str}_{role}_{original_filename_stem}"
-                else:
-                    new_filename_base = f"{time_str}_{role}"
-            
-            new_final_filename = f"{new_filename_base}{new_extension}"
-            new_final_path = output_folder / new_final_filename
-            new_final_path = get_unique_filename(new_final_path)
-
-            # Move/Copy the file to its final destination
-            if path_to_process.exists():
-                if converted_in_this_step: # If it was converted, path_to_process is temporary, so move it
-                    shutil.move(str(path_to_process), new_final_path)
-                else: # If not converted (original WebP and no JPEG conversion, or already JPEG), copy it
-                    shutil.copy2(str(path_current), new_final_path)
+        for job in jobs:
+            if job.get('duplicate_of'):
+                finished[submitted] = (job, process_entry(job, settings))
             else:
-                logging.error(f"Source path {path_to_process} does not exist before moving/copying. Skipping file.")
-                if role == 'primary': primary_images.append(None) 
-                else: secondary_images.append(None)
-                skipped_files_count +=1
+                queues[0].put((submitted, new_work(job, settings), images_per_entry))
+            submitted += 1
+            collect(block=False)
+            while next_seq in finished:
+                yield finished.pop(next_seq)
+                next_seq += 1
+        while next_seq < submitted:
+            while next_seq not in finished:
+                collect(block=True)
+            yield finished.pop(next_seq)
+            next_seq += 1
+    finally:
+        queues[0].put(None)
+        for worker in workers:
+            worker.join()
+        wall_time = time.perf_counter() - start
+        for stage_stats in stats.values():
+            del stage_stats['running']
+            # Items per second the stage could sustain with all its threads busy
+            capacity = stage_stats['busy_s'] / stage_stats['threads']
+            stage_stats['items_per_s'] = stage_stats['items'] / capacity if capacity else 0.0
+            stage_stats['utilization'] = capacity / wall_time if wall_time else 0.0
+
+# Function to read posts.json incrementally, yielding one entry at a time
+# Only the current chunk and entry are held in memory, however long the posting history is
+def iter_posts(f, chunk_size=1024 * 1024):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + text_decoder.decode(chunk, final=eof)
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            read_more()
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError("posts.json does not contain a list of posts")
+    pos += 1
+    skip_whitespace()
+    if buffer[pos:pos + 1] == ']':
+        return
+
+    while True:
+        # Decode the next entry, reading more of the file if it is cut off at the end of the buffer
+        while True:
+            try:
+                entry, pos = decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+        yield entry
+
+        skip_whitespace()
+        separator = buffer[pos:pos + 1]
+        pos += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(f"Unexpected {separator!r} between posts in posts.json")
+        skip_whitespace()
+
+# Function to build the manifest record of a planned or completed job
+def manifest_record(job, status, sources=None):
+    record = {
+        'post': job['post'],
+        'status': status,
+        'digest': job['digest'],
+        'settings': job['settings'],
+        'planned': {name: str(path) for name, path in job['planned'].items()},
+        'outputs': {name: str(job[f'{name}_output']) for name in job['planned']},
+    }
+    if sources is not None:
+        record['sources'] = sources
+    return record
+
+# Function to find an earlier post of this run with the same source images and metadata
+# Such posts produce identical outputs, e.g. when the same image is in Photos/post and Photos/bereal
+# or when overlapping exports are merged. Files are only hashed once their size and metadata match.
+def find_duplicate(job, source, candidates, hashes):
+    def content_hash(path):
+        if path not in hashes:
+            hashes[path] = file_sha256(source, path)
+        return hashes[path]
+
+    key = (source.stat(job['primary_path'])[0], source.stat(job['secondary_path'])[0],
+           job['entry']['takenAt'], json.dumps(job['location'], sort_keys=True), job['caption'])
+    for earlier in candidates.setdefault(key, []):
+        if all(content_hash(earlier[role]) == content_hash(job[f'{role}_path']) for role in ['primary', 'secondary']):
+            job['sha256'] = {role: content_hash(job[f'{role}_path']) for role in ['primary', 'secondary']}
+            return earlier['post']
+    # Only what is needed for comparing and linking is kept, not the whole job
+    candidates[key].append({'post': job['post'], 'primary': job['primary_path'], 'secondary': job['secondary_path']})
+    return None
+
+# Function to create the outputs of a duplicate post as links (or copies) of the outputs of the earlier post
+def link_duplicate(job, earlier_outputs, settings, sink):
+    source = settings['source']
+    telemetry = Telemetry(trace=settings['trace'])
+    result = new_result()
+    result['duplicates'] = 1
+    try:
+        with telemetry.stage('link'):
+            for name, earlier_output in earlier_outputs.items():
+                if sink.link(earlier_output, job[f'{name}_output'], settings['link_mode']) != 'copy':
+                    result['linked_bytes'] += sink.size(earlier_output)
+                for size in settings['thumbnail_sizes']:
+                    extension = ENCODER_PROFILES[settings['encoder_profile']]['extension']
+                    earlier_thumbnail = thumbnail_path(earlier_output, size, extension)
+                    if sink.exists(earlier_thumbnail):
+                        sink.link(earlier_thumbnail, thumbnail_path(job[f'{name}_output'], size, extension), settings['link_mode'])
+                        result['thumbnails'] += 1
+                if name == 'combined':
+                    result['combined'] += 1
+                else:
+                    result['processed'] += 1
+        result['sources'] = {role: source_fingerprint(source, job[f'{role}_path'], job['sha256'][role])
+                             for role in ['primary', 'secondary']}
+    except Exception as e:
+        logging.error(f"Error linking duplicate entry {job['entry']}: {e}")
+        result['skipped'] += 2
+    result['telemetry'] = telemetry.to_dict()
+    return result
+
+# Function to locate the input files of each entry and plan its output filenames
+# Missing files are also recorded in `missing` if it is given (for plans)
+def plan_entries(data, settings, reserved, counters, manifest, telemetry, missing=None):
+    source = settings['source']
+    candidates = {} # Earlier posts by image sizes and metadata, for finding duplicates
+    hashes = {} # Content hashes of the source images compared so far
+    reused = set() # Posts whose output names from an earlier run were taken over already (posts.json may list a post twice)
+    for entry in data:
+        try:
+            # Extract only the filename from the path and look it up in the photo_folder or bereal_folder of the source
+            primary_filename_str = Path(entry['primary']['path']).name
+            secondary_filename_str = Path(entry['secondary']['path']).name
+
+            with telemetry.stage('lookup'):
+                primary_path_initial = source.find(primary_filename_str)
+                secondary_path_initial = source.find(secondary_filename_str)
+
+            # Check if files exist after attempting both folders
+            if missing is not None:
+                missing.extend({'takenAt': entry.get('takenAt'), 'role': role, 'filename': filename}
+                               for role, filename, path in [('primary', primary_filename_str, primary_path_initial),
+                                                            ('secondary', secondary_filename_str, secondary_path_initial)]
+                               if path is None)
+            if primary_path_initial is None:
+                logging.error(f"Primary image not found: {primary_filename_str} in {photo_folder} or {bereal_folder}")
+                counters['skipped'] +=1 # Count as skipped if primary is missing
+                if secondary_path_initial is None: # If secondary also missing
+                     counters['skipped'] +=1 # Count as skipped
+                continue # Skip this entry if primary is missing
+
+            if secondary_path_initial is None:
+                logging.error(f"Secondary image not found: {secondary_filename_str} in {photo_folder} or {bereal_folder}")
+                counters['skipped'] +=1 # Count as skipped if secondary is missing
+                # We might still process primary if it exists, or skip. Current logic processes pair.
+                # For now, assume we need both to proceed with an "entry"
                 continue
 
+            # Skip posts that an earlier run already completed with the same sources and settings
+            post = f"{primary_filename_str}|{secondary_filename_str}"
+            digest = Manifest.digest(entry, settings)
+            record = manifest.get(post)
+            with telemetry.stage('manifest'):
+                up_to_date = Manifest.is_up_to_date(record, digest, source, {'primary': primary_path_initial, 'secondary': secondary_path_initial})
+            if up_to_date:
+                counters['unchanged'] += 1
+                continue
 
-            # Add metadata if converted to JPEG or if it was already JPEG and conversion was 'yes' (implicit)
-            if new_final_path.suffix.lower() == '.jpg': # Only add metadata to JPEGs
-                update_exif(new_final_path, taken_at, location, caption)
-                update_iptc(str(new_final_path), caption)
+            taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
+            job = {
+                'post': post,
+                'digest': digest,
+                'settings': Manifest.output_settings(settings),
+                'planned': {},
+                'entry': entry,
+                'taken_at': taken_at,
+                'location': entry.get('location'),  # This will be None if 'location' is not present
+                'caption': entry.get('caption'),  # This will be None if 'caption' is not present
+            }
 
-                # === FIX: Re-open and save the JPEG with Pillow to ensure integrity ===
-                try:
-                    with Image.open(new_final_path) as img_to_resave:
-                        current_exif = img_to_resave.info.get('exif')
-                        img_to_resave.save(new_final_path, "JPEG", quality=80, exif=current_exif, icc_profile=img_to_resave.info.get('icc_profile'))
-                    logging.info(f"Re-saved {new_final_path} with Pillow to ensure integrity after metadata updates.")
-                except Exception as e: # Corrected syntax here
-                    logging.error(f"Failed to re-open and re-save {new_final_path}: {e}. File might be corrupted.")
-                    if role == 'primary': primary_images.append(None) 
-                    else: secondary_images.append(None)
-                    skipped_files_count +=1
-                    continue # Skip adding this problematic file to lists for combining
-                # === End of FIX ===
-
-            if role == 'primary':
-                primary_images.append({
-                    'path': new_final_path,
-                    'taken_at': taken_at,
-                    'location': location,
-                    'caption': caption
-                })
-            else:
-                secondary_images.append(new_final_path)
+            time_str = taken_at.strftime("%Y-%m-%dT%H-%M-%S")
+            for path_current, role in [(primary_path_initial, 'primary'), (secondary_path_initial, 'secondary')]:
+                # Adjust filename based on user's choice
+                original_filename_stem = path_current.stem
 
-            logging.info(f"Successfully processed {role} image to {new_final_path}")
-            processed_files_count += 1
-            print("") # Newline for readability
-    except Exception as e:
-        logging.error(f"Error processing entry {entry}: {e}")
-        # Increment skipped count for both potential files in the entry if a general error occurs
-        skipped_files_count += 2 
+                if settings['convert_to_jpeg'] == 'yes': # Output will be JPEG (or the format of the encoder profile)
+                    new_extension = ENCODER_PROFILES[settings['encoder_profile']]['extension']
+                else: # Output will be WebP (or original format if not WebP)
+                    new_extension = path_current.suffix # Keep original extension if not converting to JPEG
 
+                if settings['keep_original_filename'] == 'yes':
+                    new_filename_base = f"{time_str}_{role}_{original_filename_stem}"
+                else:
+                    new_filename_base = f"{time_str}_{role}"
 
-# Create combined images if user chose 'yes'
-if create_combined_images == 'yes':
-    output_folder_combined.mkdir(parents=True, exist_ok=True)
+                job[f'{role}_path'] = path_current
+                job['planned'][role] = settings['output_root'] / output_folder / f"{new_filename_base}{new_extension}"
 
-    valid_primary_images = [p for p in primary_images if p is not None]
-    valid_secondary_images = [s for s in secondary_images if s is not None]
-    
-    # Ensure we have pairs
-    num_pairs = min(len(valid_primary_images), len(valid_secondary_images))
+            # Combined images are paired by entry and saved with the encoder profile (JPEG with .jpg extension by default)
+            if settings['create_combined_images'] == 'yes':
+                job['planned']['combined'] = settings['output_root'] / output_folder_combined / f"{time_str}_combined{ENCODER_PROFILES[settings['encoder_profile']]['extension']}"
+
+            reuse_names = record is not None and post not in reused
+            reused.add(post)
+            for name, planned_path in job['planned'].items():
+                # Overwrite the output of an earlier, interrupted or outdated run instead of creating a duplicate
+                if reuse_names and record['planned'].get(name) == str(planned_path):
+                    job[f'{name}_output'] = Path(record['outputs'][name])
+                    reserved.add(job[f'{name}_output'])
+                else:
+                    job[f'{name}_output'] = get_unique_filename(planned_path, reserved)
 
-    for i in range(num_pairs):
-        primary_data = valid_primary_images[i]
-        secondary_image_path_for_combine = valid_secondary_images[i]
+            with telemetry.stage('dedup'):
+                job['duplicate_of'] = find_duplicate(job, source, candidates, hashes)
 
-        if primary_data is None or secondary_image_path_for_combine is None:
-            logging.warning("Skipping combined image creation due to a missing primary or secondary image in a pair.")
+            manifest.append(manifest_record(job, 'planned'))
+            yield job
+        except Exception as e:
+            logging.error(f"Error processing entry {entry}: {e}")
+            # Increment skipped count for both potential files in the entry if a general error occurs
+            counters['skipped'] += 2
+
+# Function to create the counters of a run
+def new_counters():
+    return {'processed': 0, 'converted': 0, 'combined': 0, 'skipped': 0, 'unchanged': 0, 'duplicates': 0,
+            'linked_bytes': 0, 'thumbnails': 0, 'sidecars': 0, 'cache_hits': 0}
+
+# Function to create the result of one post, as returned by the workers and added to the counters of the run
+def new_result():
+    return {'processed': 0, 'converted': 0, 'combined': 0, 'skipped': 0, 'duplicates': 0, 'linked_bytes': 0, 'thumbnails': 0,
+            'cache_bytes': 0, 'cache_hits': 0}
+
+# Function to build the settings of an export from the answers to the prompts (or a batch config) and the command line
+def build_settings(source, output_root, options, args):
+    def yes_no(value):
+        return 'yes' if value is True or value == 'yes' else 'no'
+
+    return {
+        'source': source,
+        'output_root': Path(output_root),
+        'convert_to_jpeg': yes_no(options.get('convert_to_jpeg', 'yes')),
+        'keep_original_filename': yes_no(options.get('keep_original_filename', 'no')),
+        'create_combined_images': yes_no(options.get('create_combined_images', 'yes')),
+        'encoder_profile': options.get('profile', args.profile),
+        'thumbnail_sizes': sorted(set(options.get('thumbnails', args.thumbnails)), reverse=True),
+        'link_mode': options.get('link_mode', args.link_mode),
+        'combined_style': {
+            'scale': options.get('overlay_scale', args.overlay_scale),
+            'corner_radius': options.get('corner_radius', args.corner_radius),
+            'outline_size': options.get('outline_size', args.outline_size),
+            'position': tuple(options.get('margin', args.margin)),
+        },
+        'render_cache_mb': options.get('render_cache', args.render_cache),
+        'archive': args.archive,
+        'sync_every': args.sync_every,
+        'verbose': args.verbose,
+        'trace': args.trace is not None,
+    }
+
+# One export being processed: its settings, posts.json, manifest, reserved output names and counters
+# main() processes a single export; batch mode interleaves the jobs of several exports on one worker pool, and
+# only opens posts.json and the manifest of an export when its first job is needed (lazy=True).
+# A dry run (for plans) creates no folders and leaves the manifest as it is. With an archive, the outputs are
+# written into the archive only, and every run writes all of them (there is nothing to resume from).
+class ExportRun:
+    def __init__(self, name, settings, dry_run=False, lazy=False):
+        self.name = name
+        self.settings = settings
+        self.dry_run = dry_run
+        self.counters = new_counters()
+        self.telemetry = Telemetry(trace=settings['trace'])
+        self.completed = {} # Outputs of the posts finished in this run, for linking duplicates
+        self.pending_records = [] # Manifest records of finished posts whose outputs are not synced to disk yet
+        self.start = time.perf_counter()
+        self.end = self.start
+
+        root = settings['output_root']
+        folders = [root / output_folder, root / output_folder_combined] if settings['create_combined_images'] == 'yes' else [root / output_folder]
+        if not (dry_run or settings['archive']):
+            for folder in folders:
+                folder.mkdir(parents=True, exist_ok=True)
+                for size in settings['thumbnail_sizes']:
+                    (root / thumbnails_folder / str(size) / folder.name).mkdir(parents=True, exist_ok=True)
+
+        self.posts_file = None
+        self.manifest = None
+        if not lazy:
+            self.open()
+        # Output names are reserved while planning, in entry order, so a parallel run names files exactly like a serial one
+        self.reserved = OutputNames([] if settings['archive'] else [root / output_folder, root / output_folder_combined])
+        self.sink = DirectorySink() if dry_run else open_sink(settings)
+        self.render_cache = None if dry_run else open_render_cache(settings)
+        self.cache_bytes = 0 # Bytes added to the render cache since it was last trimmed
+        if self.render_cache is not None:
+            self.render_cache.folder.mkdir(parents=True, exist_ok=True)
+
+    # Function to open the JSON file and the manifest; entries are parsed one at a time while the images are processed
+    def open(self):
+        if self.posts_file is None:
+            self.posts_file = self.settings['source'].open_posts()
+            self.manifest = Manifest(None if self.settings['archive'] else self.settings['output_root'] / manifest_path, read_only=self.dry_run)
+
+    def jobs(self, missing=None):
+        self.open()
+        return plan_entries(iter_posts(self.posts_file), self.settings, self.reserved, self.counters, self.manifest, self.telemetry, missing)
+
+    # Function to plan re-rendering the combined images of the posts that earlier runs completed (see restyle_entry)
+    # Posts whose combined image already has the current style are skipped as unchanged
+    def restyle_jobs(self):
+        source = self.settings['source']
+        for entry in iter_posts(self.posts_file):
+            try:
+                primary_filename, secondary_filename = Path(entry['primary']['path']).name, Path(entry['secondary']['path']).name
+                post = f"{primary_filename}|{secondary_filename}"
+                record = self.manifest.get(post)
+                if record is None or record['status'] != 'done' or 'combined' not in record['outputs']:
+                    continue
+                digest = Manifest.digest(entry, self.settings)
+                if record['digest'] == digest:
+                    self.counters['unchanged'] += 1
+                    continue
+                # Posts recorded before the settings were recorded can only be checked through their digest,
+                # which matches the current settings with the default look if the other settings are the same
+                if 'settings' not in record and record['digest'] != Manifest.digest(entry, dict(self.settings, combined_style=default_combined_style)):
+                    logging.error(f"Not rendering {record['outputs']['combined']} again: it was made with other settings or another look "
+                                  f"than the current one. Process the export again with its settings first.")
+                    self.counters['skipped'] += 1
+                    continue
+                # The combined image is written over its old file, so it must keep the format its name says
+                extension = ENCODER_PROFILES[self.settings['encoder_profile']]['extension']
+                if Path(record['outputs']['combined']).suffix.lower() != extension:
+                    logging.error(f"Not rendering {record['outputs']['combined']} again: the {self.settings['encoder_profile']} "
+                                  f"profile writes {extension} files. Use the profile of the earlier run.")
+                    self.counters['skipped'] += 1
+                    continue
+                job = {
+                    'post': post,
+                    'digest': digest,
+                    'settings': Manifest.output_settings(self.settings),
+                    'planned': record['planned'],
+                    'duplicate_of': None,
+                    'entry': entry,
+                    'taken_at': datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ"),
+                    'location': entry.get('location'),
+                    'caption': entry.get('caption'),
+                    'primary_path': source.find(primary_filename),
+                    'secondary_path': source.find(secondary_filename),
+                    'sources': record['sources'],
+                    'sha256': {role: record['sources'][role]['sha256'] for role in ['primary', 'secondary']},
+                }
+                for name, output in record['outputs'].items():
+                    job[f'{name}_output'] = Path(output)
+                yield job
+            except Exception as e:
+                logging.error(f"Error processing entry {entry}: {e}")
+                self.counters['skipped'] += 1
+
+    # Function to find the settings of the earlier runs that --restyle would have to change to render the combined
+    # images again: everything but the look. Returns the command line options for the recorded values that differ.
+    def restyle_conflicts(self):
+        options = {'convert_to_jpeg': '--convert', 'keep_original_filename': '--keep-original-filename',
+                   'create_combined_images': '--combine', 'encoder_profile': '--profile', 'thumbnail_sizes': '--thumbnails'}
+        current = Manifest.output_settings(self.settings)
+        conflicts = {}
+        for record in self.manifest.previous.values():
+            if record['status'] != 'done' or 'settings' not in record:
+                continue
+            for name, option in options.items():
+                value = record['settings'][name]
+                if value != current[name]:
+                    conflicts[option] = ",".join(str(size) for size in value) if name == 'thumbnail_sizes' else value # '' for no thumbnails
+        return conflicts
+
+    # Function to account for the result of a job; results must arrive in the order of the export's jobs
+    def handle_result(self, job, result):
+        # Results arrive in entry order, so the earlier post of a duplicate is always finished first
+        if job['duplicate_of']:
+            if job['duplicate_of'] in self.completed:
+                result = link_duplicate(job, self.completed[job['duplicate_of']], self.settings, self.sink)
+            else: # The earlier post failed, so process this one after all
+                result = process_entry(dict(job, duplicate_of=None), self.settings)
+        # Outputs for an archive come back with the result, in entry order
+        for path, data in result.pop('files', []):
+            with self.telemetry.stage('archive'):
+                self.sink.write(path, data)
+        # Outputs that a worker wrote to the output folders are synced with the batch (see DirectorySink.sync)
+        if 'written' in result:
+            self.sink.written += result.pop('written')
+        for key in ['processed', 'converted', 'combined', 'skipped', 'duplicates', 'linked_bytes', 'thumbnails', 'cache_hits']:
+            self.counters[key] += result[key]
+        # Keep the render cache within its size limit while it fills up
+        self.cache_bytes += result['cache_bytes']
+        if self.render_cache is not None and self.cache_bytes > self.render_cache.max_bytes / 10:
+            with self.telemetry.stage('cache'):
+                self.render_cache.evict()
+            self.cache_bytes = 0
+        self.telemetry.merge(result['telemetry'])
+        if 'sources' in result:
+            self.pending_records.append(manifest_record(job, 'done', result['sources']))
+            self.completed[job['post']] = {name: job[f'{name}_output'] for name in job['planned']}
+        if len(self.pending_records) >= max(1, self.settings['sync_every']):
+            self.flush()
+        self.end = time.perf_counter()
+
+    # Function to flush the outputs of the finished posts to disk and only then record the posts as done,
+    # so a crash can not leave the manifest pointing at outputs that never reached the disk
+    def flush(self):
+        if self.pending_records and self.settings['sync_every']:
+            with self.telemetry.stage('sync'):
+                self.sink.sync()
+        elif not self.settings['sync_every'] and isinstance(self.sink, DirectorySink):
+            self.sink.written.clear() # Nothing is synced
+        for record in self.pending_records:
+            self.manifest.append(record)
+        self.pending_records.clear()
+
+    def close(self):
+        try:
+            self.flush()
+            self.sink.close()
+            if self.render_cache is not None:
+                self.render_cache.evict()
+        finally:
+            if self.posts_file is not None:
+                self.manifest.close()
+                self.posts_file.close()
+
+    def total_input_files(self):
+        source = self.settings['source']
+        total_input_files = source.count_files_in_folder(photo_folder)
+        if source.has_folder(bereal_folder):
+            total_input_files += source.count_files_in_folder(bereal_folder)
+        return total_input_files
+
+# Function to log the summary of one export, or of all exports of a batch
+def log_summary(counters, settings, total_input_files):
+    logging.info(f"Finished processing.\n"
+                 f"Total input WebP-files found: {total_input_files}\n"
+                 f"Total files processed (primary/secondary instances): {counters['processed']}\n"
+                 f"Files converted WebP to {ENCODER_PROFILES[settings['encoder_profile']]['format']}: {counters['converted']}\n"
+                 f"Combined images created: {counters['combined']}\n"
+                 f"Thumbnails created: {counters['thumbnails']}\n"
+                 f"Posts unchanged since an earlier run (skipped): {counters['unchanged']}\n"
+                 f"Duplicate posts processed once and linked ({settings['link_mode']}): {counters['duplicates']}\n"
+                 f"Disk space saved by hardlinks/reflinks: {counters['linked_bytes'] / 1e6:.1f} MB\n"
+                 f"Files/operations skipped due to errors: {counters['skipped']}", extra={'summary': True})
+
+# Function to find the exports of a batch: the "exports" listed in the config, and every unzipped export
+# (a folder with posts.json) or ZIP file directly inside its "root" folder. Relative paths are relative to the config.
+def find_exports(config, config_folder):
+    exports = []
+    for export in config.get('exports', []):
+        export = {'input': export} if isinstance(export, str) else dict(export)
+        export['input'] = config_folder / export['input']
+        if 'output' in export:
+            export['output'] = config_folder / export['output']
+        exports.append(export)
+    if 'root' in config:
+        for path in sorted((config_folder / config['root']).iterdir()):
+            if (path / 'posts.json').exists() or (path.suffix.lower() == '.zip' and zipfile.is_zipfile(path)):
+                exports.append({'input': path})
+    return exports
+
+# Function to interleave the jobs of several exports round-robin, one job per export in turn
+# Small exports do not wait behind large ones, and every export keeps getting workers until it runs out of jobs
+# The jobs of an export (and so its posts.json and manifest) are only opened when the round-robin first reaches it
+def interleave_jobs(runs):
+    active = deque((index, run, None) for index, run in enumerate(runs))
+    while active:
+        index, run, jobs = active.popleft()
+        if jobs is None:
+            try:
+                jobs = run.jobs()
+            except FileNotFoundError:
+                logging.error(f"posts.json not found in {run.name}, skipping this export")
+                continue
+        try:
+            job = next(jobs)
+        except StopIteration:
+            continue
+        except ValueError as e:
+            logging.error(f"Failed to read posts.json of {run.name}: {e}")
+            continue
+        job['export'] = index
+        yield job, run.settings
+        active.append((index, run, jobs))
+
+# Function to process many exports in one batch, on one shared pool of worker processes
+# The batch is described by a JSON config file (or is a folder whose exports are processed with the default settings):
+# {"root": "...", "exports": ["...", {"input": "...", "output": "...", "settings": {...}}], "settings": {...}, "workers": 8}
+def run_batch(args, run_start):
+    batch_path = Path(args.batch)
+    if batch_path.is_dir():
+        config, config_folder = {'root': '.'}, batch_path
+    else:
+        with open(batch_path, encoding="utf8") as f:
+            config = json.load(f)
+        config_folder = batch_path.parent
+
+    runs = []
+    for export in find_exports(config, config_folder):
+        input_path = Path(export['input'])
+        if not input_path.exists():
+            logging.error(f"{input_path} not found, skipping this export")
+            continue
+        # Outputs go into the export folder, or for a ZIP file into a folder of the same name next to it
+        output_root = export.get('output') or (input_path.with_suffix('') if input_path.is_file() else input_path)
+        options = dict(config.get('settings', {}), **export.get('settings', {}))
+        settings = build_settings(open_source(input_path), output_root, options, args)
+        if settings['encoder_profile'] not in ENCODER_PROFILES:
+            logging.error(f"Unknown encoder profile {settings['encoder_profile']} for {input_path}, skipping this export")
             continue
+        runs.append(ExportRun(str(input_path), settings, lazy=True))
+    if not runs:
+        logging.error("No exports found for the batch.")
+        return
 
-        primary_image_path_for_combine = primary_data['path']
-        primary_taken_at = primary_data['taken_at']
-        primary_location = primary_data['location']
-        primary_caption = primary_data['caption']
+    workers = max(1, config.get('workers', args.workers))
+    print(STYLING["BOLD"] + f"\nProcessing {len(runs)} export(s) with {workers} worker process(es):" + STYLING["RESET"])
+    for run in runs:
+        print(f"{run.name} -> {run.settings['output_root']}")
+    print("")
 
-        # Ensure paths exist before trying to combine
-        if not primary_image_path_for_combine.exists() or not secondary_image_path_for_combine.exists():
-            logging.error(f"Cannot combine: one or both files missing. Primary: {primary_image_path_for_combine}, Secondary: {secondary_image_path_for_combine}")
+    try:
+        for job, result in run_job_pairs(process_entry, interleave_jobs(runs), workers, order_key=lambda job: job['export']):
+            runs[job['export']].handle_result(job, result)
+    finally:
+        for run in runs:
+            run.close()
+
+    # Per-export summary, with a report in the output folder of every export
+    totals = new_counters()
+    telemetry = Telemetry(trace=args.trace is not None)
+    print(STYLING["BOLD"] + "\nExports:" + STYLING["RESET"])
+    print(f"{'export':<40}{'files':>8}{'combined':>10}{'unchanged':>11}{'duplicates':>12}{'skipped':>9}{'time s':>9}")
+    for run in runs:
+        print(f"{run.name[-40:]:<40}{run.counters['processed']:>8}{run.counters['combined']:>10}{run.counters['unchanged']:>11}"
+              f"{run.counters['duplicates']:>12}{run.counters['skipped']:>9}{run.end - run.start:>9.1f}")
+        run.telemetry.write_report(run.settings['output_root'] / output_folder / 'run-report.json', run.counters, run.end - run.start)
+        for key in totals:
+            totals[key] += run.counters[key]
+        telemetry.merge(run.telemetry.to_dict())
+    print("")
+
+    # Aggregate summary; the settings of the first export name the output format and link mode
+    log_summary(totals, runs[0].settings, sum(run.total_input_files() for run in runs))
+    write_run_report(args, telemetry, totals, run_start, default_path=Path(args.batch).with_suffix('.report.json') if batch_path.is_file() else batch_path / 'batch-report.json')
+
+# Function to write an XMP sidecar for every image in posts.json, straight from the JSON
+# No image is decoded, copied or changed, so this only costs a lookup and a small write per image
+def write_sidecars(data, source, counters, telemetry):
+    for entry in data:
+        try:
+            taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
+            with telemetry.stage('xmp'):
+                xmp = build_xmp(taken_at, entry.get('location'), entry.get('caption'))
+            for role in ['primary', 'secondary']:
+                filename = Path(entry[role]['path']).name
+                with telemetry.stage('lookup'):
+                    image_path = source.find(filename)
+                if image_path is None:
+                    logging.error(f"{role.capitalize()} image not found: {filename} in {photo_folder} or {bereal_folder}")
+                    counters['skipped'] += 1
+                    continue
+                sidecar = source.sidecar_path(image_path)
+                with telemetry.stage('write'):
+                    sidecar.parent.mkdir(parents=True, exist_ok=True)
+                    sidecar.write_bytes(xmp)
+                telemetry.add_bytes('written', len(xmp))
+                logging.debug(f"Wrote sidecar {sidecar}")
+                counters['sidecars'] += 1
+        except Exception as e:
+            logging.error(f"Error writing sidecars for entry {entry}: {e}")
+            counters['skipped'] += 2
+
+# Function to plan a run without processing it: the posts that would be processed, missing files, the output name
+# of every image, name collisions and the bytes read and written. It only needs posts.json, the folder listings
+# and file sizes; nothing is decoded or written. Source files are only hashed where the sizes and metadata of
+# two posts match (possible duplicates) or a source changed its mtime since the last run.
+# The bytes written by the encoder are not known before encoding, so they are estimated with the size_ratio of the profile.
+def plan_run(run):
+    settings, source = run.settings, run.settings['source']
+    profile = ENCODER_PROFILES[settings['encoder_profile']]
+    # Copies are linked instead where the link mode allows it (files in a ZIP are always copied)
+    linked = settings['link_mode'] != 'copy' and isinstance(source, DirectorySource)
+    missing = []
+    posts = []
+    bytes_read = 0
+    bytes_written = 0
+    for job in run.jobs(missing):
+        sizes = {role: source.stat(job[f'{role}_path'])[0] for role in ['primary', 'secondary']}
+        written = 0
+        for name in job['planned']:
+            encoded = sizes['primary' if name == 'combined' else name] * profile['size_ratio']
+            if name == 'combined' or settings['convert_to_jpeg'] == 'yes':
+                written += encoded
+            elif job[f'{name}_path'].suffix.lower() == '.webp':
+                written += sizes[name] # The same image data, with metadata added to the header
+            elif not linked:
+                written += sizes[name]
+            # Thumbnails shrink with their area; posts.json gives the size of the source images
+            dimensions = job['entry']['secondary' if name == 'secondary' else 'primary']
+            long_edge = max(dimensions.get('width', 1500), dimensions.get('height', 2000))
+            written += sum(encoded * min(1, size / long_edge) ** 2 for size in settings['thumbnail_sizes'])
+        if not job['duplicate_of']:
+            bytes_read += sizes['primary'] + sizes['secondary']
+            bytes_written += written
+        elif settings['link_mode'] == 'copy':
+            # Duplicates are copied (or linked) from the outputs of the earlier post, without reading their sources
+            bytes_written += written
+        posts.append({
+            'post': job['post'],
+            'takenAt': job['entry']['takenAt'],
+            'outputs': {name: str(job[f'{name}_output']) for name in job['planned']},
+            'renamed': [name for name, planned_path in job['planned'].items() if job[f'{name}_output'] != planned_path],
+            'duplicate_of': job['duplicate_of'],
+        })
+    return {
+        'input': str(source),
+        'settings': {name: settings[name] for name in ['convert_to_jpeg', 'keep_original_filename', 'create_combined_images',
+                                                       'encoder_profile', 'thumbnail_sizes', 'link_mode']},
+        'posts': len(posts),
+        'duplicates': sum(1 for post in posts if post['duplicate_of']),
+        'unchanged': run.counters['unchanged'],
+        'missing': missing,
+        'collisions': run.reserved.collisions,
+        'bytes_read': bytes_read,
+        'bytes_written_estimate': int(bytes_written),
+        'outputs': posts,
+    }
+
+# Verification of processed outputs
+# Outputs are checked from their container structure and metadata alone; the image data is only decoded when asked for.
+
+# Function to walk the segments of a JPEG file up to its image data and return its EXIF and IPTC payloads
+# A broken marker structure or a truncated file raises ValueError
+def read_jpeg_metadata(data):
+    if data[:2] != b'\xff\xd8':
+        raise ValueError("no JPEG start of image marker")
+    metadata = {'exif': None, 'iptc': None}
+    has_frame = False
+    pos = 2
+    while True:
+        if pos + 4 > len(data):
+            raise ValueError("truncated before the image data")
+        if data[pos] != 0xFF:
+            raise ValueError(f"no JPEG marker at offset {pos}")
+        marker = data[pos + 1]
+        if marker == 0xFF: # Fill byte before a marker
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7: # Markers without a length
+            pos += 2
+            continue
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if length < 2 or pos + 2 + length > len(data):
+            raise ValueError(f"truncated: segment {marker:02X} at offset {pos} runs past the end of the file")
+        payload = data[pos + 4:pos + 2 + length]
+        if marker == 0xE1 and payload.startswith(b'Exif\x00\x00'):
+            metadata['exif'] = payload
+        elif marker == 0xED and payload.startswith(b'Photoshop 3.0\x00'):
+            metadata['iptc'] = payload
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC): # Start of frame (not DHT, JPG, DAC)
+            has_frame = True
+        elif marker == 0xDA: # Start of scan: the entropy-coded image data follows, up to the end of image marker
+            break
+        elif marker == 0xD9:
+            raise ValueError("end of image marker before the image data")
+        pos += 2 + length
+    if not has_frame:
+        raise ValueError("no JPEG frame header before the image data")
+    if not data.endswith(b'\xff\xd9'):
+        raise ValueError("truncated: no end of image marker")
+    return metadata
+
+# Function to check the RIFF structure of a WebP file and return its EXIF and XMP payloads
+def read_webp_metadata(data):
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        raise ValueError("no RIFF WebP header")
+    if struct.unpack('<I', data[4:8])[0] + 8 != len(data):
+        raise ValueError(f"truncated: the RIFF header announces {struct.unpack('<I', data[4:8])[0] + 8} bytes, the file has {len(data)}")
+    chunks = dict(_webp_chunks(data))
+    if b'VP8 ' not in chunks and b'VP8L' not in chunks:
+        raise ValueError("WebP file has no image data")
+    return {'exif': chunks.get(b'EXIF'), 'xmp': chunks.get(b'XMP ')}
+
+# Function to check the box structure of an AVIF (ISO base media) file; its metadata is not checked
+def read_avif_metadata(data):
+    if data[4:8] != b'ftyp':
+        raise ValueError("no AVIF file type box")
+    pos = 0
+    while pos < len(data):
+        size = int.from_bytes(data[pos:pos + 4], 'big')
+        if size == 1: # 64-bit size after the box type
+            size = int.from_bytes(data[pos + 8:pos + 16], 'big')
+        elif size == 0: # The last box extends to the end of the file
+            size = len(data) - pos
+        if size < 8 or pos + size > len(data):
+            raise ValueError(f"truncated: box at offset {pos} runs past the end of the file")
+        pos += size
+    return {}
+
+# Function to read the caption (IPTC dataset 2:120) from the Photoshop image resources of an APP13 segment
+def _iptc_caption(app13):
+    pos = len(b'Photoshop 3.0\x00')
+    while app13[pos:pos + 4] == b'8BIM':
+        resource_id = int.from_bytes(app13[pos + 4:pos + 6], 'big')
+        name_length = app13[pos + 6]
+        pos += 6 + (name_length + 2) // 2 * 2 # The name is a Pascal string padded to an even length
+        size = int.from_bytes(app13[pos:pos + 4], 'big')
+        block = app13[pos + 4:pos + 4 + size]
+        pos += 4 + size + (size & 1)
+        if resource_id != 0x0404: # IPTC-NAA records
             continue
+        record_pos = 0
+        while record_pos + 5 <= len(block) and block[record_pos] == 0x1C:
+            length = int.from_bytes(block[record_pos + 3:record_pos + 5], 'big')
+            if block[record_pos + 1:record_pos + 3] == b'\x02\x78':
+                return block[record_pos + 5:record_pos + 5 + length].decode('utf-8', errors='replace')
+            record_pos += 5 + length
+    return None
+
+# Function to read the caption (dc:description) from an XMP packet written by build_xmp
+def _xmp_caption(xmp):
+    xmp = xmp.decode('utf-8', errors='replace')
+    start = xmp.find('<rdf:li xml:lang="x-default">', xmp.find('<dc:description>'))
+    if '<dc:description>' not in xmp or start < 0:
+        return None
+    start += len('<rdf:li xml:lang="x-default">')
+    return xmp[start:xmp.find('</rdf:li>', start)].replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+# Function to compare the metadata of an output with its posts.json entry, as written by build_metadata
+def check_metadata(metadata, entry):
+    taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
+    caption = entry.get('caption') or None
+    if metadata['exif'] is None:
+        return ["no EXIF data"]
+    problems = []
+    exif = piexif.load(metadata['exif'])
+    expected = piexif.load(build_exif(taken_at, entry.get('location'), caption))
+    date = exif['Exif'].get(piexif.ExifIFD.DateTimeOriginal, b'').decode('ascii', errors='replace')
+    if date != taken_at.strftime("%Y:%m:%d %H:%M:%S"):
+        problems.append(f"EXIF DateTimeOriginal is {date!r}, expected {taken_at.strftime('%Y:%m:%d %H:%M:%S')!r}")
+    if exif['GPS'] != expected['GPS']:
+        problems.append(f"EXIF GPS position does not match the location {entry.get('location')}")
+    if exif['0th'].get(piexif.ImageIFD.ImageDescription) != expected['0th'].get(piexif.ImageIFD.ImageDescription):
+        problems.append(f"EXIF ImageDescription does not match the caption {caption!r}")
+    # JPEG files carry the caption in IPTC as well, WebP files in XMP
+    if 'iptc' in metadata:
+        if metadata['iptc'] is None:
+            problems.append("no IPTC data")
+        elif _iptc_caption(metadata['iptc']) != caption:
+            problems.append(f"IPTC caption is {_iptc_caption(metadata['iptc'])!r}, expected {caption!r}")
+    if 'xmp' in metadata:
+        if metadata['xmp'] is None:
+            problems.append("no XMP data")
+        elif _xmp_caption(metadata['xmp']) != caption:
+            problems.append(f"XMP caption is {_xmp_caption(metadata['xmp'])!r}, expected {caption!r}")
+    return problems
+
+# Function to verify one output file; returns a list of problems (empty if the file is fine)
+# `entry` is its posts.json entry, or None for a file that the manifest does not know
+def verify_file(path, entry, full_decode=False):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return [f"cannot be read: {e}"]
+    readers = {'.jpg': read_jpeg_metadata, '.jpeg': read_jpeg_metadata, '.webp': read_webp_metadata, '.avif': read_avif_metadata}
+    reader = readers.get(Path(path).suffix.lower())
+    if reader is None:
+        return []
+    try:
+        metadata = reader(data)
+    except ValueError as e:
+        return [str(e)]
+    problems = check_metadata(metadata, entry) if entry is not None and metadata else []
+    if full_decode:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+        except Exception as e:
+            problems.append(f"does not decode: {e}")
+    return problems
+
+# Function to verify a batch of output files (runs in a worker)
+def verify_files(files, settings):
+    return [(path, verify_file(path, entry, settings['full_decode'])) for path, entry in files]
+
+# Function to index the posts.json entries by post, as the manifest records them ("<primary name>|<secondary name>")
+def index_posts(source):
+    entries = {}
+    with source.open_posts() as f:
+        for entry in iter_posts(f):
+            try:
+                entries[f"{Path(entry['primary']['path']).name}|{Path(entry['secondary']['path']).name}"] = entry
+            except (KeyError, TypeError):
+                continue
+    return entries
+
+# Function to verify the outputs in output_folder and output_folder_combined against posts.json and the manifest
+# Files are verified in parallel, in batches, so the per-file overhead of the worker pool stays small
+def verify_outputs(source, workers, full_decode=False, batch_size=64):
+    entries = index_posts(source)
+    # The manifest tells which post every output belongs to
+    manifest = Manifest(manifest_path, read_only=True)
+    expected = {} # Output path -> posts.json entry
+    for record in manifest.records.values():
+        if record['status'] == 'done' and record['post'] in entries:
+            for output in record['outputs'].values():
+                expected[str(output)] = entries[record['post']]
+
+    files = []
+    for folder in [output_folder, output_folder_combined]:
+        try:
+            with os.scandir(folder) as folder_entries:
+                files += sorted(str(folder / entry.name) for entry in folder_entries
+                                if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith('.json'))
+        except FileNotFoundError:
+            pass
+    present = set(files)
+    report = {
+        'files': len(files),
+        'unrecorded': [path for path in files if path not in expected],
+        'missing': sorted(path for path in expected if path not in present),
+        'problems': {},
+        'full_decode': full_decode,
+    }
+    batches = [[(path, expected.get(path)) for path in files[start:start + batch_size]] for start in range(0, len(files), batch_size)]
+    settings = {'full_decode': full_decode}
+    for _, results in run_job_pairs(verify_files, ((batch, settings) for batch in batches), workers):
+        for path, problems in results:
+            if problems:
+                report['problems'][path] = problems
+                logging.error(f"{path}: " + "; ".join(problems))
+    return report
+
+# Mosaics
+# A mosaic is one overview image of the outputs of a year or a month. It is rendered in tiles, one row of cells
+# high, on the worker pool, and every tile is compressed in its worker as a piece of one PNG data stream. The tiles
+# are written to the file in order as they come back, so a mosaic is never in memory as a whole: peak memory
+# depends on the width of a mosaic and the number of workers, not on the number of posts.
+
+# Background of the cells without a post
+mosaic_background = (24, 24, 24)
+
+# Function to find the output shown for every post in a mosaic (the combined image, or else the primary image)
+# with the time the post was taken, oldest first
+def mosaic_posts(source):
+    entries = index_posts(source)
+    manifest = Manifest(manifest_path, read_only=True)
+    posts = []
+    for record in manifest.records.values():
+        entry = entries.get(record['post'])
+        output = record['outputs'].get('combined') or record['outputs'].get('primary')
+        if record['status'] != 'done' or entry is None or output is None:
+            continue
+        try:
+            taken_at = datetime.strptime(entry['takenAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
+        except (KeyError, TypeError, ValueError):
+            continue
+        posts.append((taken_at, output))
+    posts.sort()
+    return posts
+
+# Function to lay out one mosaic per year or month (`period`), with the output shown in every cell
+# The calendar layout has one cell per day: a year is a grid of months (rows) by days (columns), and a month is a
+# calendar of weeks (rows) by weekdays (columns, starting on Monday). Only the first post of a day is shown.
+# The contact layout shows every post in order, in a grid that is about as wide as it is high.
+def layout_mosaics(posts, period, layout):
+    groups = {}
+    for taken_at, output in posts:
+        groups.setdefault(taken_at.strftime('%Y' if period == 'year' else '%Y-%m'), []).append((taken_at, output))
+
+    mosaics = []
+    for name, group in groups.items():
+        cells = {} # (column, row) -> output
+        hidden = 0
+        if layout == 'contact':
+            # Cells are 3:4, so a grid that is about square has 4/3 as many columns as rows
+            columns = math.ceil(math.sqrt(len(group) * 4 / 3))
+            rows = math.ceil(len(group) / columns)
+            for index, (_, output) in enumerate(group):
+                cells[(index % columns, index // columns)] = output
+        else:
+            year, month = group[0][0].year, group[0][0].month
+            first_weekday, days = calendar.monthrange(year, month)
+            columns, rows = (31, 12) if period == 'year' else (7, math.ceil((first_weekday + days) / 7))
+            for taken_at, output in group:
+                if period == 'year':
+                    cell = (taken_at.day - 1, taken_at.month - 1)
+                else:
+                    cell = (taken_at.weekday(), (first_weekday + taken_at.day - 1) // 7)
+                if cell in cells:
+                    hidden += 1
+                else:
+                    cells[cell] = output
+        mosaics.append({'name': name, 'columns': columns, 'rows': rows, 'cells': cells, 'hidden': hidden})
+    return mosaics
+
+# Function to split a mosaic into its tiles, one row of cells each, as jobs for render_mosaic_tile
+def mosaic_tiles(mosaic, settings):
+    cell_width, _ = settings['mosaic_cell']
+    for row in range(mosaic['rows']):
+        yield {
+            'mosaic': mosaic['name'],
+            'row': row,
+            'width': mosaic['columns'] * cell_width,
+            'cells': [(column * cell_width, mosaic['cells'][(column, row)]) for column in range(mosaic['columns'])
+                      if (column, row) in mosaic['cells']],
+        }
+
+# Function to render one tile of a mosaic and compress it as a piece of the PNG data stream (runs in a worker)
+# Outputs are decoded at about the size of a cell: JPEG files are decoded at 1/2 to 1/8 scale with draft mode.
+# The scanlines use the PNG "Sub" filter (each byte minus the byte one pixel to the left, computed with Pillow),
+# and the compressed data ends on a byte boundary (Z_SYNC_FLUSH), so the tiles of a mosaic can be concatenated.
+def render_mosaic_tile(tile, settings):
+    cell_width, cell_height = settings['mosaic_cell']
+    result = {'cells': 0, 'errors': []}
+    tile_image = Image.new('RGB', (tile['width'], cell_height), mosaic_background)
+    for x, output in tile['cells']:
+        try:
+            with Image.open(output) as img:
+                img.draft('RGB', (cell_width, cell_height))
+                # Crop to the aspect ratio of the cell, around the centre
+                scale = max(cell_width / img.width, cell_height / img.height)
+                crop_width, crop_height = cell_width / scale, cell_height / scale
+                left, top = (img.width - crop_width) / 2, (img.height - crop_height) / 2
+                rgb_image = img.convert('RGB') if img.mode != 'RGB' else img
+                cell_image = rgb_image.resize((cell_width, cell_height), Image.Resampling.LANCZOS,
+                                              box=(left, top, left + crop_width, top + crop_height))
+            tile_image.paste(cell_image, (x, 0))
+            cell_image.close()
+            result['cells'] += 1
+        except Exception as e:
+            result['errors'].append(f"{output}: {e}")
+
+    shifted_image = Image.new('RGB', tile_image.size)
+    shifted_image.paste(tile_image.crop((0, 0, tile_image.width - 1, cell_height)), (1, 0))
+    filtered = ImageChops.subtract_modulo(tile_image, shifted_image).tobytes()
+    tile_image.close()
+    shifted_image.close()
+    stride = tile['width'] * 3
+    scanlines = b''.join(b'\x01' + filtered[start:start + stride] for start in range(0, len(filtered), stride))
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15) # Raw deflate data; the zlib header is written by PngWriter
+    result['data'] = compressor.compress(scanlines) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    result['adler32'] = zlib.adler32(scanlines)
+    result['length'] = len(scanlines)
+    return result
+
+# Function to compute the Adler-32 checksum of two pieces of data from their checksums, as adler32_combine in zlib
+# `length2` is the length of the second piece
+def adler32_combine(adler1, adler2, length2):
+    base = 65521
+    remainder = length2 % base
+    sum1 = ((adler1 & 0xffff) + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (remainder * (adler1 & 0xffff) + (adler1 >> 16) + (adler2 >> 16) + base - remainder) % base
+    return sum1 | (sum2 << 16)
+
+# PNG file (8-bit RGB) written from compressed tiles, top to bottom. Every tile is written as an IDAT chunk as soon
+# as it comes; the zlib header and the Adler-32 checksum of the whole data stream are added around the tiles here.
+# Like the outputs of a run, the file is written under a temporary name and renamed into place once it is complete.
+class PngWriter:
+    def __init__(self, path, width, height):
+        self.path = Path(path)
+        self.adler32 = 1 # Adler-32 of no data
+        self.file = open(temp_path(self.path), 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        self.write_chunk(b'IDAT', b'\x78\x9c') # zlib header: deflate with a 32 KB window
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)) + chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_tile(self, data, adler32, length):
+        self.write_chunk(b'IDAT', data)
+        self.adler32 = adler32_combine(self.adler32, adler32, length)
+
+    def close(self):
+        # End the deflate data with an empty final block, then the checksum
+        end = zlib.compressobj(6, zlib.DEFLATED, -15).flush()
+        self.write_chunk(b'IDAT', end + struct.pack('>I', self.adler32))
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+        os.replace(temp_path(self.path), self.path)
+
+# Function to render the mosaics of the posts into mosaic_folder, one PNG file per year or month
+def render_mosaics(posts, settings, workers):
+    mosaics = {mosaic['name']: mosaic for mosaic in layout_mosaics(posts, settings['mosaic_period'], settings['mosaic_layout'])}
+    cell_width, cell_height = settings['mosaic_cell']
+    suffix = '_contact' if settings['mosaic_layout'] == 'contact' else ''
+    mosaic_folder.mkdir(parents=True, exist_ok=True)
+    report = {'mosaics': [], 'cells': 0, 'hidden': 0, 'errors': []}
+    writer = None
+    tiles = ((tile, settings) for mosaic in mosaics.values() for tile in mosaic_tiles(mosaic, settings))
+    for tile, result in run_job_pairs(render_mosaic_tile, tiles, workers):
+        mosaic = mosaics[tile['mosaic']]
+        if tile['row'] == 0:
+            path = mosaic_folder / f"{mosaic['name']}{suffix}.png"
+            writer = PngWriter(path, tile['width'], mosaic['rows'] * cell_height)
+        writer.write_tile(result['data'], result['adler32'], result['length'])
+        report['cells'] += result['cells']
+        for error in result['errors']:
+            logging.error(f"Could not add to mosaic {mosaic['name']}: {error}")
+        report['errors'] += result['errors']
+        if tile['row'] == mosaic['rows'] - 1:
+            writer.close()
+            report['hidden'] += mosaic['hidden']
+            report['mosaics'].append({'path': str(writer.path), 'width': tile['width'], 'height': mosaic['rows'] * cell_height,
+                                      'posts': len(mosaic['cells']), 'hidden': mosaic['hidden']})
+            logging.debug(f"Mosaic written: {writer.path}")
+    return report
+
+# Function to write the run report at the end of a run
+def write_run_report(args, telemetry, counters, run_start, default_path=output_folder / 'run-report.json'):
+    if args.report:
+        report_path = Path(args.report)
+    elif args.archive:
+        report_path = Path(args.archive).with_suffix('.report.json') # Next to the archive, so the input export stays untouched
+    else:
+        report_path = default_path
+    telemetry.write_report(report_path, counters, time.perf_counter() - run_start, args.trace)
+    print(f"Run report written to {report_path}")
+    if args.trace:
+        print(f"Trace written to {args.trace}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert, rename and tag the photos of a BeReal GDPR export.")
+    parser.add_argument('--input', default='.',
+                        help="unzipped export folder or the BeReal GDPR ZIP file itself (default: current folder)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of CPU cores)")
+    parser.add_argument('--batch', default=None, metavar='CONFIG',
+                        help="process many exports on one worker pool: a JSON config file, or a folder with unzipped exports and ZIP files")
+    parser.add_argument('--sidecars', action='store_true',
+                        help="only write an XMP sidecar with the metadata next to every image, without converting or copying images")
+    parser.add_argument('--plan', action='store_true',
+                        help="only plan the run: report missing files, output names, name collisions and the bytes to read "
+                             "and write, without decoding or writing any image")
+    parser.add_argument('--verify', action='store_true',
+                        help="check the outputs of earlier runs: JPEG/WebP/AVIF structure, truncation, and EXIF, GPS and caption "
+                             "against posts.json, without decoding the images")
+    parser.add_argument('--full-decode', action='store_true',
+                        help="with --verify, also decode every image completely")
+    parser.add_argument('--mosaic', choices=['year', 'month'], default=None,
+                        help="only build one overview image per year or month from the outputs of earlier runs, in Photos/post/__mosaics")
+    parser.add_argument('--mosaic-layout', choices=['calendar', 'contact'], default='calendar',
+                        help="calendar: one cell per day, in a grid of months by days or a month calendar; "
+                             "contact: every post in order (default: calendar)")
+    parser.add_argument('--mosaic-cell', type=int, default=200, metavar='PX',
+                        help="height of a cell in a mosaic in pixels; cells are 3:4 like BeReal images (default: 200)")
+    parser.add_argument('--convert', choices=['yes', 'no'], default=None,
+                        help="convert images from WebP to JPEG (or the format of --profile); skips the prompts (default: yes)")
+    parser.add_argument('--keep-original-filename', choices=['yes', 'no'], default=None,
+                        help="keep the original filename in the renamed files; skips the prompts (default: no)")
+    parser.add_argument('--combine', choices=['yes', 'no'], default=None,
+                        help="create combined images like the original BeReal memories; skips the prompts (default: yes)")
+    parser.add_argument('--profile', choices=list(ENCODER_PROFILES), default=default_profile,
+                        help="encoder profile for converted and combined images (default: jpeg, baseline JPEG at quality 80)")
+    parser.add_argument('--thumbnails', type=lambda value: [int(size) for size in value.split(',')], default=[],
+                        metavar='SIZES', help="also write thumbnails with these long-edge sizes in pixels, e.g. 1080,512,256")
+    parser.add_argument('--overlay-scale', type=float, default=default_combined_style['scale'],
+                        help="size of the secondary image in combined images, relative to its original size (default: 0.3)")
+    parser.add_argument('--corner-radius', type=int, default=default_combined_style['corner_radius'],
+                        help="radius of the rounded corners of the secondary image in combined images (default: 60)")
+    parser.add_argument('--outline-size', type=int, default=default_combined_style['outline_size'],
+                        help="thickness of the black outline around the secondary image in combined images (default: 7)")
+    parser.add_argument('--margin', type=lambda value: tuple(int(part) for part in value.split(',')),
+                        default=default_combined_style['position'], metavar='X,Y',
+                        help="margin of the secondary image to the left and top border in combined images (default: 55,55)")
+    parser.add_argument('--render-cache', type=int, default=0, metavar='MB',
+                        help="keep the decoded frames of combined images in a cache of this size, so --restyle can "
+                             "render them again without decoding (default: 0, no cache)")
+    parser.add_argument('--restyle', action='store_true',
+                        help="only render the combined images of earlier runs again, with the current style settings")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="process in one process with a pipeline of threads for reading, decoding, encoding and writing, "
+                             "using --workers threads for decoding and encoding")
+    parser.add_argument('--max-images', type=int, default=16,
+                        help="maximum number of images in flight in the pipeline, which limits memory use (default: 16)")
+    parser.add_argument('--link-mode', choices=['copy', 'hardlink', 'reflink'], default='copy',
+                        help="how copied files and outputs of duplicate posts are created; hardlink and reflink "
+                             "fall back to copy where the filesystem does not support them (default: copy)")
+    parser.add_argument('--archive', default=None, metavar='PATH',
+                        help="write all outputs into this tar (.tar, .tar.gz) or ZIP (.zip) archive instead of the output folders")
+    parser.add_argument('--sync-every', type=int, default=100, metavar='POSTS',
+                        help="flush the outputs to disk after this many posts, before recording them as done; 0 never flushes (default: 100)")
+    parser.add_argument('--verbose', action='store_true',
+                        help="log every processed file (by default only errors and the summary are shown)")
+    parser.add_argument('--report', default=None,
+                        help="where to write the JSON run report (default: run-report.json in the output folder, or next to the --archive)")
+    parser.add_argument('--trace', default=None,
+                        help="also write a Chrome trace (chrome://tracing, Perfetto) of all stages to this file")
+    args = parser.parse_args()
+
+    # Pillow is only loaded for runs that encode images
+    if not (args.plan or args.sidecars or args.verify):
+        Image.init()
+        if ENCODER_PROFILES[args.profile]['format'] not in Image.SAVE:
+            parser.error(f"the {args.profile} profile needs {ENCODER_PROFILES[args.profile]['format']} support, which this Pillow installation does not have")
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    run_start = time.perf_counter()
+    telemetry = Telemetry(trace=args.trace is not None)
+
+    if args.batch:
+        if args.pipeline or args.sidecars or args.plan or args.archive or args.verify or args.restyle or args.mosaic:
+            parser.error("--batch cannot be combined with --pipeline, --sidecars, --plan, --archive, --verify, --restyle or --mosaic")
+        run_batch(args, run_start)
+        return
+
+    # Initialize counters
+    counters = new_counters()
+
+    if not (args.plan or args.archive):
+        output_folder.mkdir(parents=True, exist_ok=True)  # Create the output folder if it doesn't exist
+
+    source = open_source(args.input)
+
+    # Print the paths
+    print(STYLING["BOLD"] + "\nThe following paths are set for the input and output files:" + STYLING["RESET"])
+    if isinstance(source, ZipSource):
+        print(f"Input archive: {source}")
+    print(f"Photo folder: {photo_folder}")
+    if source.has_folder(bereal_folder):
+        print(f"Older photo folder: {bereal_folder}")
+    if args.archive and not args.plan:
+        print(f"Output archive: {args.archive}")
+    else:
+        print(f"Output folder for singular images: {output_folder}")
+        print(f"Output folder for combined images: {output_folder_combined}")
+    #print("\nDeduplication is active. No files will be overwritten or deleted.")
+    print("")
 
-        timestamp_str = primary_image_path_for_combine.stem.split('_')[0] # Assumes YYYY-MM-DDTHH-MM-SS format at start
+    number_of_files = source.count_files_in_folder(photo_folder)
+    print(f"Number of WebP-files in {photo_folder}: {number_of_files}")
 
-        # Corrected: Save combined image as JPEG with .jpg extension
-        combined_filename = f"{timestamp_str}_combined.jpg"
-        combined_image_final_path = output_folder_combined / combined_filename
-        combined_image_final_path = get_unique_filename(combined_image_final_path) # Ensure unique name
+    if source.has_folder(bereal_folder):
+        number_of_files_bereal = source.count_files_in_folder(bereal_folder) # Use a different variable name
+        print(f"Number of (older) WebP-files in {bereal_folder}: {number_of_files_bereal}")
 
+    # Sidecar mode: only write XMP files with the metadata from posts.json; the images are left as they are
+    if args.sidecars:
+        try:
+            posts_file = source.open_posts()
+        except FileNotFoundError:
+            logging.error("JSON file not found. Please check the path.")
+            exit()
+        with posts_file:
+            try:
+                write_sidecars(iter_posts(posts_file), source, counters, telemetry)
+            except ValueError as e:
+                logging.error(f"Failed to read posts.json: {e}")
+        logging.info(f"Finished writing sidecars.\n"
+                     f"XMP sidecars written: {counters['sidecars']}\n"
+                     f"Files skipped due to errors: {counters['skipped']}", extra={'summary': True})
+        write_run_report(args, telemetry, counters, run_start)
+        return
+
+    # Verify mode: check the outputs of earlier runs against posts.json and the manifest, without processing anything
+    if args.verify:
+        try:
+            report = verify_outputs(source, max(1, args.workers), args.full_decode)
+        except FileNotFoundError:
+            logging.error("JSON file not found. Please check the path.")
+            exit()
+        except ValueError as e:
+            logging.error(f"Failed to read posts.json: {e}")
+            exit()
+        report['elapsed_ms'] = (time.perf_counter() - run_start) * 1000
+        logging.info(f"Finished verifying{' (with a full decode)' if args.full_decode else ''}.\n"
+                     f"Output files checked: {report['files']}\n"
+                     f"Files with problems: {len(report['problems'])}\n"
+                     f"Files not recorded in the manifest (structure checked only): {len(report['unrecorded'])}\n"
+                     f"Files recorded in the manifest but missing: {len(report['missing'])}\n"
+                     f"Verified in {report['elapsed_ms']:.0f} ms", extra={'summary': True})
+        for path in report['missing']:
+            logging.error(f"Missing output: {path}")
+        report_path = Path(args.report) if args.report else output_folder / 'verify-report.json'
+        with open(report_path, 'w', encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Verify report written to {report_path}")
+        if report['problems'] or report['missing']:
+            exit(1)
+        return
+
+    # Mosaic mode: build overview images from the outputs of earlier runs, without processing anything
+    if args.mosaic:
+        try:
+            posts = mosaic_posts(source)
+        except FileNotFoundError:
+            logging.error("JSON file not found. Please check the path.")
+            exit()
+        except ValueError as e:
+            logging.error(f"Failed to read posts.json: {e}")
+            exit()
+        settings = {
+            'mosaic_period': args.mosaic,
+            'mosaic_layout': args.mosaic_layout,
+            'mosaic_cell': (max(1, round(args.mosaic_cell * 3 / 4)), max(1, args.mosaic_cell)),
+        }
+        report = render_mosaics(posts, settings, max(1, args.workers))
+        report['elapsed_ms'] = (time.perf_counter() - run_start) * 1000
+        logging.info(f"Finished building mosaics.\n"
+                     f"Mosaics written to {mosaic_folder}: {len(report['mosaics'])}\n"
+                     f"Posts shown: {report['cells']}\n"
+                     f"Posts not shown (not the first post of their day): {report['hidden']}\n"
+                     f"Outputs that could not be read: {len(report['errors'])}\n"
+                     f"Built in {report['elapsed_ms']:.0f} ms", extra={'summary': True})
+        report_path = Path(args.report) if args.report else mosaic_folder / 'mosaic-report.json'
+        with open(report_path, 'w', encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Mosaic report written to {report_path}")
+        return
+
+    # Settings
+    ## There are no prompts for a plan or when settings are given on the command line
+    advanced_settings = 'no'
+    if not (args.plan or args.restyle) and all(value is None for value in [args.convert, args.keep_original_filename, args.combine]):
+        ## Initial choice for accessing advanced settings
+        print(STYLING["BOLD"] + "\nDo you want to access advanced settings or run with default settings?" + STYLING["RESET"])
+        print("Default settings are:\n"
+        "1. Copied images are converted from WebP to JPEG\n"
+        "2. Converted images' filenames do not contain the original filename\n"
+        "3. Combined images are created on top of converted, singular images")
+        advanced_settings = input("\nEnter " + STYLING["BOLD"] + "'yes'" + STYLING["RESET"] + "for advanced settings or press any key to continue with default settings: ").strip().lower()
+
+        if advanced_settings != 'yes':
+            print("Continuing with default settings.\n")
+
+    ## Default responses (or the settings from the command line)
+    convert_to_jpeg = args.convert or 'yes'
+    keep_original_filename = args.keep_original_filename or 'no'
+    create_combined_images = args.combine or 'yes'
+
+    ## Proceed with advanced settings if chosen
+    if advanced_settings == 'yes':
+        # User choice for converting to JPEG
+        convert_to_jpeg = None
+        while convert_to_jpeg not in ['yes', 'no']:
+            convert_to_jpeg = input(STYLING["BOLD"] + "\n1. Do you want to convert images from WebP to JPEG? (yes/no): " + STYLING["RESET"]).strip().lower()
+            if convert_to_jpeg == 'no':
+                print("Your images will not be converted. Metadata will be added to the WebP files without re-encoding them.")
+            if convert_to_jpeg not in ['yes', 'no']:
+                logging.error("Invalid input. Please enter 'yes' or 'no'.")
+
+        # User choice for keeping original filename
+        print(STYLING["BOLD"] + "\n2. There are two options for how output files can be named" + STYLING["RESET"] + "\n"
+        "Option 1: YYYY-MM-DDTHH-MM-SS_primary/secondary_original-filename.jpeg\n"
+        "Option 2: YYYY-MM-DDTHH-MM-SS_primary/secondary.jpeg\n"
+        "This will only influence the naming scheme of singular images.")
+        keep_original_filename = None
+        while keep_original_filename not in ['yes', 'no']:
+            keep_original_filename = input(STYLING["BOLD"] + "Do you want to keep the original filename in the renamed file? (yes/no): " + STYLING["RESET"]).strip().lower()
+            if keep_original_filename not in ['yes', 'no']:
+                logging.error("Invalid input. Please enter 'yes' or 'no'.")
+
+        # User choice for creating combined images
+        create_combined_images = None
+        while create_combined_images not in ['yes', 'no']:
+            create_combined_images = input(STYLING["BOLD"] + "\n3. Do you want to create combined images like the original BeReal memories? (yes/no): " + STYLING["RESET"]).strip().lower()
+            if create_combined_images not in ['yes', 'no']:
+                logging.error("Invalid input. Please enter 'yes' or 'no'.")
+
+    if convert_to_jpeg == 'no' and create_combined_images == 'no':
+        print("You chose not to convert images nor do you want to output combined images.\n"
+        "The script will therefore only copy images to a new folder, add metadata to them and rename them according to your choice without creating new files.\n"
+        "Script will continue to run in 5 seconds.")
+        #time.sleep(5) # Corrected sleep duration from 10 to 5 as per message
+
+    settings = build_settings(source, Path('.'), {
+        'convert_to_jpeg': convert_to_jpeg,
+        'keep_original_filename': keep_original_filename,
+        'create_combined_images': create_combined_images,
+    }, args)
+
+    # Plan mode: plan the names and sizes of all outputs from posts.json and the folder listings, and stop there
+    if args.plan:
         try:
-            combined_image_pil = combine_images_with_resizing(primary_image_path_for_combine, secondary_image_path_for_combine)
-            combined_image_pil.save(combined_image_final_path, 'JPEG', quality=80) # Save as JPEG
-            combined_image_pil.close()
-            combined_files_count += 1
-            logging.info(f"Combined image saved: {combined_image_final_path}")
+            run = ExportRun(str(source), settings, dry_run=True)
+        except FileNotFoundError:
+            logging.error("JSON file not found. Please check the path.")
+            exit()
+        try:
+            plan = plan_run(run)
+        except ValueError as e:
+            logging.error(f"Failed to read posts.json: {e}")
+            return
+        finally:
+            run.close()
+        plan['elapsed_ms'] = (time.perf_counter() - run_start) * 1000
+        for post in plan['outputs']:
+            logging.debug(f"{post['takenAt']}: " + ", ".join(post['outputs'].values()))
+        logging.info(f"Finished planning (nothing was decoded or written).\n"
+                     f"Posts to process: {plan['posts']}\n"
+                     f"Duplicate posts to link ({settings['link_mode']}): {plan['duplicates']}\n"
+                     f"Posts unchanged since an earlier run (skipped): {plan['unchanged']}\n"
+                     f"Files missing from the export: {len(plan['missing'])}\n"
+                     f"Output names taken, with a _1, _2, ... suffix added: {plan['collisions']}\n"
+                     f"Data to read: {plan['bytes_read'] / 1e6:.1f} MB\n"
+                     f"Data to write (estimate): {plan['bytes_written_estimate'] / 1e6:.1f} MB\n"
+                     f"Planned in {plan['elapsed_ms']:.0f} ms", extra={'summary': True})
+        plan_path = Path(args.report or 'plan.json')
+        with open(plan_path, 'w', encoding="utf8") as f:
+            json.dump(plan, f, indent=2)
+        print(f"Plan written to {plan_path}")
+        return
+
+    workers = max(1, args.workers)
+
+    # Restyle mode: render the combined images of earlier runs again, from the render cache where possible
+    if args.restyle:
+        if args.archive:
+            parser.error("--restyle cannot be combined with --archive")
+        try:
+            run = ExportRun(str(source), settings)
+        except FileNotFoundError:
+            logging.error("JSON file not found. Please check the path.")
+            exit()
+        # Only the look can change: the other settings must be those of the earlier runs, or the digests and
+        # the names of the outputs would no longer match their contents
+        conflicts = run.restyle_conflicts()
+        if conflicts:
+            run.close()
+            logging.error("The earlier runs used other settings, which --restyle can not change. Run it with: "
+                          + ", ".join(f"{option} {value}" if value else f"no {option}" for option, value in conflicts.items()))
+            exit()
+        print(f"Rendering combined images again with {workers} worker process(es).\n")
+        try:
+            for job, result in run_jobs(restyle_entry, run.restyle_jobs(), settings, workers):
+                run.handle_result(job, result)
+        except ValueError as e:
+            logging.error(f"Failed to read posts.json: {e}")
+        finally:
+            run.close()
+        logging.info(f"Finished rendering combined images again.\n"
+                     f"Combined images rendered: {run.counters['combined']}\n"
+                     f"Thumbnails created: {run.counters['thumbnails']}\n"
+                     f"Frames loaded from the render cache instead of decoded: {run.counters['cache_hits']}\n"
+                     f"Posts already in this style (skipped): {run.counters['unchanged']}\n"
+                     f"Combined images skipped due to errors: {run.counters['skipped']}", extra={'summary': True})
+        write_run_report(args, run.telemetry, run.counters, run_start)
+        return
+
+    if args.pipeline:
+        print(f"Processing with a pipeline of {workers} decode/encode thread(s) and at most {args.max_images} images in flight.\n")
+    else:
+        print(f"Processing with {workers} worker process(es).\n")
 
-            # Add metadata to the new combined JPEG
-            update_exif(combined_image_final_path, primary_taken_at, primary_location, primary_caption)
-            update_iptc(str(combined_image_final_path), primary_caption)
+    try:
+        run = ExportRun(str(source), settings)
+    except FileNotFoundError:
+        logging.error("JSON file not found. Please check the path.")
+        exit()
 
-            # === FIX: Re-save the combined JPEG with Pillow to ensure integrity ===
-            try:
-                with Image.open(combined_image_final_path) as img_to_resave_combined:
-                    current_exif_combined = img_to_resave_combined.info.get('exif')
-                    img_to_resave_combined.save(combined_image_final_path, "JPEG", quality=80, exif=current_exif_combined, icc_profile=img_to_resave_combined.info.get('icc_profile'))
-                logging.info(f"Re-saved combined image {combined_image_final_path} with Pillow to ensure integrity.")
-            except Exception as e_resave_combined:
-                logging.error(f"Failed to re-open and re-save combined image {combined_image_final_path}: {e_resave_combined}.")
-            # === End of FIX ===
-
-        except FileNotFoundError as e_fnf:
-            logging.error(f"Error creating combined image. File not found: {e_fnf}")
-        except UnidentifiedImageError as e_uie:
-             logging.error(f"Error creating combined image. UnidentifiedImageError for one of the inputs: {e_uie}. Primary: {primary_image_path_for_combine}, Secondary: {secondary_image_path_for_combine}")
-        except Exception as e_combine:
-            logging.error(f"Error during combined image creation or metadata update for {combined_image_final_path}: {e_combine}")
-        
-        print("") # Newline for readability
-
-# Clean up backup files
-print(STYLING['BOLD'] + "\nRemoving backup files left behind by iptcinfo3..." + STYLING["RESET"])
-remove_backup_files(output_folder)
-if create_combined_images == 'yes': remove_backup_files(output_folder_combined)
-print("Backup file cleanup finished.\n")
-
-# Summary
-# Recalculate number_of_files if bereal_folder was used
-total_input_files = count_files_in_folder(photo_folder)
-if os.path.exists(bereal_folder):
-    total_input_files += count_files_in_folder(bereal_folder)
-
-
-logging.info(f"Finished processing.\n"
-             f"Total input WebP-files found: {total_input_files}\n"
-             f"Total files processed (primary/secondary instances): {processed_files_count}\n"
-             f"Files converted WebP to JPEG: {converted_files_count}\n"
-             f"Combined images created: {combined_files_count}\n"
-             f"Files/operations skipped due to errors: {skipped_files_count}")
+    # Process files
+    try:
+        if args.pipeline:
+            results = run_pipeline(run.jobs(), settings, workers, max(1, args.max_images), run.telemetry.pipeline)
+        else:
+            results = run_jobs(process_entry, run.jobs(), settings, workers)
+        for job, result in results:
+            run.handle_result(job, result)
+    except ValueError as e:
+        logging.error(f"Failed to read posts.json: {e}")
+    finally:
+        run.close()
+
+    # Summary
+    counters, telemetry = run.counters, run.telemetry
+    log_summary(counters, settings, run.total_input_files())
+
+    # Show the throughput of every pipeline stage; the stage with the highest utilization is the bottleneck
+    if telemetry.pipeline:
+        print(STYLING["BOLD"] + "\nPipeline stages:" + STYLING["RESET"])
+        print(f"{'stage':<8}{'threads':>8}{'items':>8}{'items/s':>10}{'busy':>8}{'starved s':>11}{'blocked s':>11}{'memory wait s':>15}")
+        for name, stage_stats in telemetry.pipeline.items():
+            print(f"{name:<8}{stage_stats['threads']:>8}{stage_stats['items']:>8}{stage_stats['items_per_s']:>10.1f}"
+                  f"{stage_stats['utilization']:>8.0%}{stage_stats['starved_s']:>11.2f}{stage_stats['blocked_s']:>11.2f}{stage_stats['memory_wait_s']:>15.2f}")
+        bottleneck = max(telemetry.pipeline, key=lambda name: telemetry.pipeline[name]['utilization'])
+        print(f"Bottleneck stage: {bottleneck}")
+
+    # Write the run report with per-stage timings, so runs can be compared
+    write_run_report(args, telemetry, counters, run_start)
+
+if __name__ == '__main__':
+    main()